@@ -0,0 +1,350 @@
+import json
+import os
+import queue
+import resource
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+import pathos
+import rich
+
+from config import (ADMISSION_CGROUP, CPU_BUDGET, JOB_MEMORY, JOB_MEMORY_FILE,
+                    MEMORY_BUDGET)
+
+MIB = 1 << 20
+
+# Jobs observed before the learned peak replaces the configured estimate
+MIN_SAMPLES = 8
+# Learned estimates are the largest peak of the last WINDOW jobs, plus this
+# margin, so that they follow a change of the workload in both directions
+WINDOW = 32
+HEADROOM = 1.25
+
+
+def meminfo(field):
+    """Value of a /proc/meminfo field in bytes, or None if unavailable"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, value = line.split(":", 1)
+                if name == field:
+                    return int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def estimate_key(job_type, project):
+    return job_type if project is None else f"{project}/{job_type}"
+
+
+def load_estimates():
+    """Peak memory in bytes learned by earlier runs, see `estimate_key`"""
+    try:
+        return json.loads(JOB_MEMORY_FILE.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_estimate(key, peak):
+    estimates = load_estimates()
+    estimates[key] = peak
+    JOB_MEMORY_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = JOB_MEMORY_FILE.with_name(f"{JOB_MEMORY_FILE.name}.{os.getpid()}")
+    tmp.write_text(json.dumps(estimates, indent=2, sort_keys=True))
+    tmp.rename(JOB_MEMORY_FILE)
+
+
+# cgroup root and cgroup of the current job of a pool worker
+_cgroup_root = None
+_job_cgroup = None
+_job_count = 0
+
+# Interval between two samples of the memory of a job without cgroup
+SAMPLE_INTERVAL = 0.05
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def _init_worker(cgroup_root):
+    global _cgroup_root
+    _cgroup_root = cgroup_root
+
+
+def _enter_job_cgroup(memory_max):
+    """Move the worker into a new cgroup for the next job
+
+    Memory stays charged to the cgroup it was allocated in, so the
+    `memory.peak` of a fresh cgroup only counts the allocations of this job
+    and of its subprocesses.
+    """
+    global _job_cgroup, _job_count
+    path = Path(_cgroup_root) / f"worker-{os.getpid()}-{_job_count}"
+    _job_count += 1
+    path.mkdir()
+    (path / "memory.max").write_text(str(memory_max))
+    (path / "cgroup.procs").write_text(str(os.getpid()))
+    previous, _job_cgroup = _job_cgroup, path
+    if previous is not None:
+        try:
+            previous.rmdir()
+        except OSError:
+            pass
+
+
+def _cgroup_stat(cgroup, name, key=None):
+    text = (cgroup / name).read_text()
+    if key is None:
+        return int(text)
+    for line in text.splitlines():
+        field, value = line.split()
+        if field == key:
+            return int(value)
+    return 0
+
+
+def _descendants_rss(pid):
+    """Total RSS in bytes of the running descendants of `pid`"""
+    total = 0
+    stack = [pid]
+    while stack:
+        cur = stack.pop()
+        try:
+            for task in os.listdir(f"/proc/{cur}/task"):
+                with open(f"/proc/{cur}/task/{task}/children") as f:
+                    stack.extend(map(int, f.read().split()))
+            if cur != pid:
+                with open(f"/proc/{cur}/statm") as f:
+                    total += int(f.read().split()[1]) * PAGE_SIZE
+        except OSError:
+            # The process exited meanwhile
+            continue
+    return total
+
+
+class _Sampler(threading.Thread):
+    """Peak RSS of the subprocesses of the worker, sampled during a job"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        pid = os.getpid()
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            self.peak = max(self.peak, _descendants_rss(pid))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+def _max_child_rss():
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def _run_job(func, item, memory_max):
+    """Run one job in a pool worker
+
+    The peak memory of the job is the `memory.peak` of its own cgroup when
+    limits are enforced. Otherwise, the RSS of the subprocesses is sampled
+    while the job runs; a subprocess larger than every earlier one of the
+    worker is also caught by `ru_maxrss` after it exits, however short.
+
+    Returns:
+        tuple: Result of `func`, peak memory of the job in bytes, and number
+        of processes killed by the cgroup memory limit during the job
+    """
+    if _cgroup_root is not None:
+        _enter_job_cgroup(memory_max)
+        result = func(item)
+        peak = _cgroup_stat(_job_cgroup, "memory.peak")
+        oom_kills = _cgroup_stat(_job_cgroup, "memory.events", "oom_kill")
+        return result, peak, oom_kills
+
+    before = _max_child_rss()
+    sampler = _Sampler()
+    sampler.start()
+    try:
+        result = func(item)
+    finally:
+        peak = sampler.stop()
+    after = _max_child_rss()
+    if after > before:
+        peak = max(peak, after)
+    return result, peak, 0
+
+
+class AdmissionPool:
+    """Process pool admitting jobs within a memory and CPU budget
+
+    At most `CPU_BUDGET` jobs run at a time. A job is admitted only while the
+    memory estimates of the running jobs, plus its own, fit in
+    `MEMORY_BUDGET` and the system still has that much memory available. A
+    job is always admitted when nothing is running, so one job larger than
+    the budget still makes progress.
+
+    The estimate starts from the peak learned by an earlier run on the same
+    project, or else from `JOB_MEMORY`, and follows the peak memory of the
+    recently finished jobs (see `_run_job`). The learned peak is saved in
+    `JOB_MEMORY_FILE` on close.
+
+    When `ADMISSION_CGROUP` names a delegated cgroup v2 directory, each job
+    runs in its own child cgroup whose `memory.max` is twice the estimate,
+    so a runaway job is killed instead of the whole machine swapping.
+
+    Args:
+        job_type (string): Kind of job, e.g. "unit_carving"
+        project (string): Project name, estimates are learned per project
+        memory (int): Memory estimate of a job in MiB, overriding the
+            configured and learned ones
+        cpus (int): Maximum number of concurrent jobs
+    """
+
+    def __init__(self, job_type, project=None, memory=None, cpus=None):
+        self.job_type = job_type
+        self.key = estimate_key(job_type, project)
+        self.cpus = cpus or CPU_BUDGET
+        self.budget = MEMORY_BUDGET * MIB
+
+        learned = load_estimates().get(self.key)
+        if memory is not None:
+            self.prior = memory * MIB
+        elif learned is not None:
+            self.prior = int(learned * HEADROOM)
+        else:
+            self.prior = JOB_MEMORY.get(job_type, JOB_MEMORY["default"]) * MIB
+        self.fixed = memory is not None
+        self.peaks = deque(maxlen=WINDOW)
+        self.samples = 0
+
+        self.cgroup = self._setup_cgroup()
+        self.pool = pathos.helpers.mp.Pool(
+            self.cpus, initializer=_init_worker, initargs=(self.cgroup,)
+        )
+
+        self.jobs = 0
+        self.max_running = 0
+        self.throttled = 0
+        self.throttled_time = 0
+        self.oom_kills = 0
+
+    def _setup_cgroup(self):
+        if ADMISSION_CGROUP is None:
+            return None
+        root = Path(ADMISSION_CGROUP)
+        try:
+            if "memory" not in (root / "cgroup.controllers").read_text().split():
+                raise OSError("memory controller is not available")
+            (root / "cgroup.subtree_control").write_text("+memory")
+        except OSError as e:
+            rich.print(f"[red]Memory limits are not enforced, {root}: {e}")
+            return None
+        return root
+
+    @property
+    def estimate(self):
+        """Current memory estimate of a job in bytes"""
+        if self.fixed:
+            return self.prior
+        if self.samples < MIN_SAMPLES:
+            return max([self.prior, *self.peaks])
+        return int(max(self.peaks) * HEADROOM)
+
+    def _can_admit(self, reserved, running):
+        if running == 0:
+            return True
+        if running >= self.cpus or reserved + self.estimate > self.budget:
+            return False
+        available = meminfo("MemAvailable")
+        return available is None or available >= self.estimate
+
+    def imap_unordered(self, func, items):
+        """Run `func` on each item, yielding results as jobs finish"""
+        items = iter(items)
+        done = queue.Queue()
+        reserved = 0
+        running = 0
+        throttled_since = None
+        next_item = next(items, StopIteration)
+
+        while next_item is not StopIteration or running > 0:
+            # Admit jobs while they fit
+            while next_item is not StopIteration:
+                if not self._can_admit(reserved, running):
+                    # Held back by memory rather than by CPUs
+                    if running < self.cpus and throttled_since is None:
+                        throttled_since = time.monotonic()
+                        self.throttled += 1
+                    break
+                if throttled_since is not None:
+                    self.throttled_time += time.monotonic() - throttled_since
+                    throttled_since = None
+                estimate = self.estimate
+                self.pool.apply_async(
+                    _run_job,
+                    (func, next_item, 2 * estimate),
+                    callback=lambda r, e=estimate: done.put((r, e, None)),
+                    error_callback=lambda x, e=estimate: done.put((None, e, x)),
+                )
+                reserved += estimate
+                running += 1
+                self.jobs += 1
+                self.max_running = max(self.max_running, running)
+                next_item = next(items, StopIteration)
+
+            if running == 0:
+                continue
+
+            # Wait for a job, rechecking available memory now and then
+            try:
+                out, estimate, error = done.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            reserved -= estimate
+            running -= 1
+            if error is not None:
+                raise error
+
+            result, peak, oom_kills = out
+            self.peaks.append(peak)
+            self.samples += 1
+            self.oom_kills += oom_kills
+            yield result
+
+    def report(self):
+        rich.print(
+            f"[green]{self.key}: {self.jobs} jobs, at most {self.max_running} "
+            f"running, estimate {self.estimate // MIB} MiB, "
+            f"throttled {self.throttled} times ({self.throttled_time:.1f}s)"
+        )
+        if self.oom_kills > 0:
+            rich.print(
+                f"[red]{self.key}: {self.oom_kills} processes killed by memory.max"
+            )
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        if self.samples > 0 and not self.fixed:
+            save_estimate(self.key, max(self.peaks))
+        if self.cgroup is not None:
+            for path in self.cgroup.glob("worker-*"):
+                try:
+                    path.rmdir()
+                except OSError:
+                    pass
+        if self.jobs > 0:
+            self.report()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.pool.terminate()
+        self.close()
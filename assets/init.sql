@@ -8,19 +8,53 @@ CREATE TABLE IF NOT EXISTS function (
     UNIQUE(project, function_name)
 );
 
+-- context holds carve_common.pack_context output and context_hash its
+-- client-side hash (storage.context_hash). Tables from before that change,
+-- with a TEXT context, are refused by storage.check_schema.
 CREATE TABLE IF NOT EXISTS system_carving (
     project VARCHAR(255) NOT NULL,
     function_name VARCHAR(255) NOT NULL,
-    context TEXT NOT NULL,
+    context BYTEA NOT NULL,
     context_hash bigint not null,
     UNIQUE (project, function_name, context_hash)
 );
 
+-- Number of contexts in system_carving, maintained on insert
+CREATE TABLE IF NOT EXISTS system_carving_count (
+    project VARCHAR(255) NOT NULL,
+    function_name VARCHAR(255) NOT NULL,
+    count BIGINT NOT NULL,
+    UNIQUE (project, function_name)
+);
+
+CREATE OR REPLACE FUNCTION count_system_carving() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO system_carving_count (project, function_name, count)
+    SELECT project, function_name, COUNT(*) FROM inserted
+    GROUP BY project, function_name
+    ON CONFLICT (project, function_name)
+    DO UPDATE SET count = system_carving_count.count + EXCLUDED.count;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS system_carving_count_trigger ON system_carving;
+CREATE TRIGGER system_carving_count_trigger
+    AFTER INSERT ON system_carving
+    REFERENCING NEW TABLE AS inserted
+    FOR EACH STATEMENT EXECUTE FUNCTION count_system_carving();
+
+-- Counts of the contexts stored before the trigger existed
+INSERT INTO system_carving_count (project, function_name, count)
+SELECT project, function_name, COUNT(*) FROM system_carving
+WHERE NOT EXISTS (SELECT 1 FROM system_carving_count)
+GROUP BY project, function_name;
+
 CREATE TABLE IF NOT EXISTS unit_carving (
     project VARCHAR(255) NOT NULL,
     function_name VARCHAR(255) NOT NULL,
     testcase VARCHAR(255) NOT NULL,
-    context TEXT NOT NULL,
+    context BYTEA NOT NULL,
     context_hash bigint not null,
     is_crash BOOLEAN NOT NULL,
     sanitizer_report TEXT,
@@ -28,10 +62,32 @@ CREATE TABLE IF NOT EXISTS unit_carving (
     UNIQUE(project, function_name, context_hash, expr_index)
 );
 
+-- Lookup of crashing testcases when storing their sanitizer report
+CREATE INDEX IF NOT EXISTS unit_carving_testcase_idx
+    ON unit_carving (project, function_name, testcase, expr_index);
+
 CREATE TABLE IF NOT EXISTS system_fuzz(
     project VARCHAR(255) NOT NULL,
     testcase VARCHAR(255) NOT NULL,
     sanitizer_report TEXT,
     expr_index INT NOT NULL,
     UNIQUE(project, testcase, expr_index)
-)
\ No newline at end of file
+);
+
+-- Crash contexts of unit_carving are looked up by hash in system_carving
+CREATE INDEX IF NOT EXISTS unit_carving_crash_idx
+    ON unit_carving (project, function_name, context_hash) WHERE is_crash;
+
+-- Unit crash contexts also carved at system level, i.e. feasible crashes.
+-- Refreshed by storage.refresh_feasible_unit_crash.
+CREATE MATERIALIZED VIEW IF NOT EXISTS feasible_unit_crash AS
+SELECT u.project, u.function_name, u.context_hash, u.expr_index, u.testcase
+FROM unit_carving u
+JOIN system_carving s
+    ON s.project = u.project
+    AND s.function_name = u.function_name
+    AND s.context_hash = u.context_hash
+WHERE u.is_crash;
+
+CREATE UNIQUE INDEX IF NOT EXISTS feasible_unit_crash_idx
+    ON feasible_unit_crash (project, function_name, context_hash, expr_index);
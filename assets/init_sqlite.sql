@@ -0,0 +1,84 @@
+CREATE TABLE IF NOT EXISTS function (
+    project TEXT NOT NULL,
+    function_name TEXT NOT NULL,
+    declaration TEXT NOT NULL,
+    UNIQUE(project, function_name)
+);
+
+CREATE TABLE IF NOT EXISTS system_carving (
+    project TEXT NOT NULL,
+    function_name TEXT NOT NULL,
+    context BLOB NOT NULL,
+    context_hash INTEGER NOT NULL,
+    UNIQUE (project, function_name, context_hash)
+);
+
+-- Number of contexts in system_carving, maintained on insert
+CREATE TABLE IF NOT EXISTS system_carving_count (
+    project TEXT NOT NULL,
+    function_name TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    UNIQUE (project, function_name)
+);
+
+-- Counts of the contexts stored before the trigger existed
+INSERT INTO system_carving_count (project, function_name, count)
+SELECT project, function_name, COUNT(*) FROM system_carving
+WHERE NOT EXISTS (SELECT 1 FROM system_carving_count)
+GROUP BY project, function_name;
+
+CREATE TRIGGER IF NOT EXISTS system_carving_count_trigger
+AFTER INSERT ON system_carving
+BEGIN
+    INSERT INTO system_carving_count (project, function_name, count)
+    VALUES (NEW.project, NEW.function_name, 1)
+    ON CONFLICT (project, function_name) DO UPDATE SET count = count + 1;
+END;
+
+CREATE TABLE IF NOT EXISTS system_carving_raw (
+    project TEXT NOT NULL,
+    function_name TEXT NOT NULL,
+    context TEXT NOT NULL,
+    context_hash INTEGER NOT NULL,
+    UNIQUE (project, function_name, context_hash)
+);
+
+CREATE TABLE IF NOT EXISTS unit_carving (
+    project TEXT NOT NULL,
+    function_name TEXT NOT NULL,
+    testcase TEXT NOT NULL,
+    context BLOB NOT NULL,
+    context_hash INTEGER NOT NULL,
+    is_crash BOOLEAN NOT NULL,
+    sanitizer_report TEXT,
+    expr_index INTEGER NOT NULL,
+    UNIQUE(project, function_name, context_hash, expr_index)
+);
+
+-- Lookup of crashing testcases when storing their sanitizer report
+CREATE INDEX IF NOT EXISTS unit_carving_testcase_idx
+    ON unit_carving (project, function_name, testcase, expr_index);
+
+CREATE TABLE IF NOT EXISTS system_fuzz(
+    project TEXT NOT NULL,
+    testcase TEXT NOT NULL,
+    sanitizer_report TEXT,
+    expr_index INTEGER NOT NULL,
+    UNIQUE(project, testcase, expr_index)
+);
+
+-- Crash contexts of unit_carving are looked up by hash in system_carving
+CREATE INDEX IF NOT EXISTS unit_carving_crash_idx
+    ON unit_carving (project, function_name, context_hash) WHERE is_crash;
+
+-- Unit crash contexts also carved at system level, i.e. feasible crashes.
+-- SQLite has no materialized view, the table is refreshed by
+-- storage.refresh_feasible_unit_crash.
+CREATE TABLE IF NOT EXISTS feasible_unit_crash (
+    project TEXT NOT NULL,
+    function_name TEXT NOT NULL,
+    context_hash INTEGER NOT NULL,
+    expr_index INTEGER NOT NULL,
+    testcase TEXT NOT NULL,
+    UNIQUE (project, function_name, context_hash, expr_index)
+);
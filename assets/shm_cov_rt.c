@@ -0,0 +1,129 @@
+// Coverage runtime for binaries built with
+// -fsanitize-coverage=inline-8bit-counters,pc-table (see Coverage.build_shm).
+//
+// The process runs many inputs of a libFuzzer-style harness. Input paths are
+// read from stdin, one per line. Before each input the counters are reset;
+// after it they are copied to the POSIX shared memory object named by
+// SHM_COV_NAME and "done" is written back. Layout of the shared memory:
+//
+//   uint64_t num_counters
+//   uint64_t reserved
+//   uint8_t  counters[num_counters]  (padded to 8 bytes)
+//   uint64_t pcs[num_counters]       (offsets from the load address)
+//   uint64_t flags[num_counters]     (1 for the entry block of a function)
+#define _GNU_SOURCE
+#include <dlfcn.h>
+#include <fcntl.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <unistd.h>
+
+int LLVMFuzzerTestOneInput(const uint8_t *data, size_t size);
+__attribute__((weak)) int LLVMFuzzerInitialize(int *argc, char ***argv);
+
+static uint8_t *counters_start, *counters_end;
+static const uintptr_t *pcs_start, *pcs_end;
+
+void __sanitizer_cov_8bit_counters_init(uint8_t *start, uint8_t *stop) {
+  // Only the main executable is tracked
+  if (counters_start == NULL) {
+    counters_start = start;
+    counters_end = stop;
+  }
+}
+
+void __sanitizer_cov_pcs_init(const uintptr_t *start, const uintptr_t *stop) {
+  if (pcs_start == NULL) {
+    pcs_start = start;
+    pcs_end = stop;
+  }
+}
+
+static int read_file(const char *path, uint8_t **data, size_t *size) {
+  FILE *f = fopen(path, "rb");
+  if (f == NULL)
+    return -1;
+  fseek(f, 0, SEEK_END);
+  long len = ftell(f);
+  fseek(f, 0, SEEK_SET);
+  *data = malloc(len > 0 ? len : 1);
+  *size = fread(*data, 1, len, f);
+  fclose(f);
+  return 0;
+}
+
+int main(int argc, char **argv) {
+  const char *name = getenv("SHM_COV_NAME");
+  if (name == NULL) {
+    fprintf(stderr, "SHM_COV_NAME is not set\n");
+    return 1;
+  }
+
+  // Keep stdout for the protocol, the harness writes to /dev/null
+  FILE *proto = fdopen(dup(STDOUT_FILENO), "w");
+  int devnull = open("/dev/null", O_WRONLY);
+  dup2(devnull, STDOUT_FILENO);
+  close(devnull);
+
+  if (LLVMFuzzerInitialize)
+    LLVMFuzzerInitialize(&argc, &argv);
+
+  size_t n = counters_end - counters_start;
+  size_t padded = (n + 7) / 8 * 8;
+  size_t size = 16 + padded + 2 * n * sizeof(uint64_t);
+
+  int fd = shm_open(name, O_CREAT | O_RDWR, 0600);
+  if (fd < 0 || ftruncate(fd, size) != 0) {
+    perror("shm_open");
+    return 1;
+  }
+  uint8_t *shm = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+  close(fd);
+  if (shm == MAP_FAILED) {
+    perror("mmap");
+    return 1;
+  }
+
+  uint64_t *header = (uint64_t *)shm;
+  uint8_t *out = shm + 16;
+  uint64_t *pcs = (uint64_t *)(out + padded);
+  header[0] = n;
+  header[1] = 0;
+
+  Dl_info info;
+  uintptr_t base = 0;
+  if (dladdr((void *)main, &info) != 0)
+    base = (uintptr_t)info.dli_fbase;
+  for (size_t i = 0; pcs_start != NULL && i < n; i++) {
+    pcs[i] = pcs_start[2 * i] - base;
+    pcs[n + i] = pcs_start[2 * i + 1];
+  }
+
+  fprintf(proto, "ready %zu\n", n);
+  fflush(proto);
+
+  char path[4096];
+  while (fgets(path, sizeof(path), stdin) != NULL) {
+    path[strcspn(path, "\n")] = '\0';
+
+    uint8_t *data;
+    size_t data_size;
+    if (read_file(path, &data, &data_size) != 0) {
+      fprintf(proto, "error\n");
+      fflush(proto);
+      continue;
+    }
+
+    memset(counters_start, 0, n);
+    LLVMFuzzerTestOneInput(data, data_size);
+    memcpy(out, counters_start, n);
+    free(data);
+
+    fprintf(proto, "done\n");
+    fflush(proto);
+  }
+  return 0;
+}
@@ -0,0 +1,149 @@
+"""Throughput of `carve_common.process_context` on synthetic contexts
+
+Contexts are generated with nested pointers, structs, pointer offsets and
+unreached values in the carver output format. With `--baseline`, another
+`carve_common.py`, given as a git revision or a file path, is measured on
+the same contexts, and both outputs are checked to be identical. A change
+of `process_context` is measured against its parent commit with
+
+    python bench_process_context.py --revision <rev> --baseline <rev>^
+
+Revisions that number pointers canonically produce a different output than
+revisions before that change.
+"""
+import argparse
+import random
+import subprocess
+import time
+import types
+from pathlib import Path
+
+import rich
+
+import carve_common
+
+PRIMITIVES = ["i8", "i16", "i32", "i64", "f32", "f64", "func"]
+
+
+class ContextGenerator:
+    def __init__(self, seed, max_depth=6, width=8):
+        self.random = random.Random(seed)
+        self.max_depth = max_depth
+        self.width = width
+        self.lines = []
+        self.next_ptr = 0
+        self.emitted = []
+
+    def mark(self):
+        # "%" marks a reached value
+        return "%" if self.random.random() < 0.6 else "#"
+
+    def primitive(self):
+        typ = self.random.choice(PRIMITIVES + ["struct.anon"])
+        value = self.random.choice(["?", str(self.random.randint(-100, 100)), "0"])
+        self.lines.append(f"{self.mark()} {typ} {value}")
+
+    def pointer(self):
+        name = self.next_ptr
+        self.next_ptr += 1
+        typ = self.random.choice(["i8", "i32", "struct.node", "%struct.foo", "union.u"])
+        size = self.random.randint(1, self.width)
+        self.lines.append(f"{self.mark()} {typ} p{name}[{size}]")
+        self.emitted.append((name, typ))
+        return name, typ, size
+
+    def body(self, name, typ, size, depth):
+        self.lines.append(f"# PTR_BEGIN {name}")
+        for i in range(size):
+            self.lines.append(f"# PTR_IDX {i}")
+            pending = []
+            if typ.startswith(("struct", "%struct", "union")):
+                self.lines.append("# STRUCT_BEGIN")
+                for _ in range(self.random.randint(1, self.width)):
+                    self.field(depth, pending)
+                self.lines.append(f"{self.mark()} STRUCT_END")
+            else:
+                self.field(depth, pending)
+            for ptr in pending:
+                self.body(*ptr, depth + 1)
+        self.lines.append(f"# PTR_END {name}")
+
+    def field(self, depth, pending):
+        x = self.random.random()
+        if depth < self.max_depth and x < 0.3:
+            pending.append(self.pointer())
+        elif x < 0.4 and self.emitted:
+            name, typ = self.random.choice(self.emitted)
+            mark = self.mark()
+            offset = self.random.randint(0, 8)
+            self.lines.append(f"{mark} {typ} * {name}+{offset}")
+        else:
+            self.primitive()
+
+    def context(self, num_args=3):
+        for _ in range(num_args):
+            if self.random.random() < 0.5:
+                self.primitive()
+            else:
+                self.body(*self.pointer(), 1)
+        return "\n".join(self.lines) + "\n"
+
+
+def load_module(spec):
+    """`carve_common` module from a file path or a git revision"""
+    path = Path(spec)
+    if path.is_file():
+        source = path.read_bytes()
+        filename = str(path)
+    else:
+        source = subprocess.check_output(["git", "show", f"{spec}:carve_common.py"])
+        filename = f"{spec}:carve_common.py"
+    module = types.ModuleType(f"carve_common_{spec}")
+    exec(compile(source, filename, "exec"), module.__dict__)
+    return module
+
+
+def measure(module, contexts, repeat):
+    """Best time of `repeat` passes over the contexts, and the outputs"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = [module.process_context(c) for c in contexts]
+        best = min(best, time.perf_counter() - start)
+    return best, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--revision",
+        help="git revision or file to measure, the working tree by default",
+    )
+    parser.add_argument("--baseline", help="git revision or file to compare with")
+    parser.add_argument("-n", type=int, default=20, help="number of contexts")
+    parser.add_argument("--repeat", type=int, default=5, help="passes, best is kept")
+    args = parser.parse_args()
+
+    contexts = [ContextGenerator(seed).context() for seed in range(args.n)]
+    lines = sum(len(c.splitlines()) for c in contexts)
+
+    if args.revision is None:
+        module, name = carve_common, "working tree"
+    else:
+        module, name = load_module(args.revision), args.revision
+    elapsed, outputs = measure(module, contexts, args.repeat)
+    rich.print(f"[green]{name}: {lines / elapsed / 1e3:.0f}k lines/s ({lines} lines)")
+
+    if args.baseline is not None:
+        base_elapsed, base_outputs = measure(
+            load_module(args.baseline), contexts, args.repeat
+        )
+        rich.print(f"[green]{args.baseline}: {lines / base_elapsed / 1e3:.0f}k lines/s")
+        rich.print(f"[green]speedup: {base_elapsed / elapsed:.2f}x")
+        if outputs != base_outputs:
+            rich.print("[red]Outputs differ from the baseline")
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
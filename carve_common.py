@@ -1,12 +1,39 @@
-import re
-from queue import Queue
+import gc
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import zlib
+from collections import deque
+from pathlib import Path
 
 import rich
 
 TYPE_PREFIX = ["struct", "%struct", "class", "union"]
 
 
+PTR_KEYWORDS = ("PTR_BEGIN", "PTR_END", "PTR_IDX")
+
+# Prefixes of primitive-type lines, e.g. "i32 0" or "struct.foo ?"
+PRIMITIVE_PREFIX = (
+    "i8",
+    "i16",
+    "i32",
+    "i64",
+    "f32",
+    "f64",
+    "func",
+    "struct",
+    "%struct",
+    "class",
+    "union",
+)
+
+
 class Value:
+    __slots__ = ("value", "type", "reached")
+
     def __init__(self, value, typ, reached):
         self.value = value
         self.type = typ
@@ -25,44 +52,33 @@ def remove_type_prefix(type_name):
 
 
 class PrimitiveValue(Value):
-    def __init__(self, value, typ, reached):
-        super().__init__(value, typ, reached)
+    __slots__ = ()
 
     def dependent_ptrs(self):
         return []
 
-    def val_string(self):
-        return f"{self.value}"
+    def encode_val(self, ids):
+        return self.value
 
-    def expr_string(self):
-        return f"{self.type} {self.value}"
+    def encode_expr(self, ids):
+        return ["v", self.type, self.value]
 
 
 class PointerValue(Value):
+    __slots__ = ("alloc_size", "name", "done")
+
     def __init__(self, type, alloc_size, name, reached):
-        super().__init__([], type, reached)
+        self.value = []
+        self.type = type
+        self.reached = reached
         self.alloc_size = alloc_size
         self.name = name
         self.done = False
 
-    # WARNING: This is naive implementation.
-    #      We should consider the case where two pointers are pointing each other:
-    #      p1 -> p2, p3
-    #      p2 -> p1,
-    #      p3 -> (some used data)
-    #      In this case, p1 and p2 should be marked as reached.
-    #      However, this implementation will mark only p1 as reached.
     def reach_update(self):
         if self.done:
             return
-        self.done = True
-        for elem in self.value:
-            if isinstance(elem, PointerValue):
-                if not elem.done:
-                    elem.reach_update()
-                self.reached = self.reached or elem.reached
-            else:
-                self.reached = self.reached or elem.reached
+        update_reached(self)
 
     def append(self, value):
         self.value.append(value)
@@ -70,37 +86,40 @@ class PointerValue(Value):
     def dependent_ptrs(self):
         res = []
         for elem in self.value:
-            if isinstance(elem, PointerValue):
+            elem_type = type(elem)
+            if elem_type is PointerValue:
                 res.append(elem)
-            else:
+            elif elem_type is not PrimitiveValue:
                 res.extend(elem.dependent_ptrs())
         return res
 
-    def val_string(self):
-        return f"p{self.name}"
+    def encode_val(self, ids):
+        return ["p", ids.setdefault(self, len(ids))]
 
-    def expr_string(self):
-        value_strs = []
-        for i, elem in enumerate(self.value):
-            if elem.reached:
-                value_strs.append(f"{i}:{elem.val_string()}")
+    def encode_expr(self, ids):
+        name = ids.setdefault(self, len(ids))
+        elems = [(i, elem) for i, elem in enumerate(self.value) if elem.reached]
 
         # Length 2 truncation
-        if len(value_strs) > 2:
-            value_strs = [value_strs[0], value_strs[-1]]
+        if len(elems) > 2:
+            elems = [elems[0], elems[-1]]
 
-        value_str = ", ".join(value_strs)
-        type_str = remove_type_prefix(self.type)
-
-        if value_strs == []:
-            return f"{type_str} p{self.name}[{len(self.value)}]"
-        else:
-            return f"{type_str} p{self.name}[{len(self.value)}] = [{value_str}]"
+        return [
+            "P",
+            name,
+            remove_type_prefix(self.type),
+            len(self.value),
+            [[i, elem.encode_val(ids)] for i, elem in elems],
+        ]
 
 
 class StructValue(Value):
+    __slots__ = ()
+
     def __init__(self, type, reached):
-        super().__init__([], type, reached)
+        self.value = []
+        self.type = type
+        self.reached = reached
 
     def append(self, value):
         self.value.append(value)
@@ -108,49 +127,104 @@ class StructValue(Value):
     def dependent_ptrs(self):
         res = []
         for elem in self.value:
-            if isinstance(elem, PointerValue):
+            elem_type = type(elem)
+            if elem_type is PointerValue:
                 res.append(elem)
-            else:
+            elif elem_type is not PrimitiveValue:
                 res.extend(elem.dependent_ptrs())
         return res
 
-    def val_string(self):
-        value_strs = []
-        for i, val in enumerate(self.value):
-            if val.reached:
-                value_strs.append(f"{i}:{val.val_string()}")
-        inner = "{" + ", ".join(value_strs) + "}"
-        return inner
+    def encode_val(self, ids):
+        return ["s", [[i, val.encode_val(ids)] for i, val in enumerate(self.value) if val.reached]]
 
-    def expr_string(self):
+    def encode_expr(self, ids):
         # We don't know struct fields, so indicate it by indices
-        value_strs = []
+        fields = []
         for i, val in enumerate(self.value):
             if val.reached:
                 if isinstance(val, PointerValue):
-                    value_strs.append(f"{i}:{val.val_string()}")
+                    fields.append([i, val.encode_val(ids)])
                 else:
-                    value_strs.append(f"{i}:{val.expr_string()}")
-
-        inner = "{" + ", ".join(value_strs) + "}"
+                    fields.append([i, val.encode_expr(ids)])
 
-        return f"{self.type} {inner}"
+        return ["S", self.type, fields]
 
 
 class PointerOffsetValue(Value):
+    __slots__ = ("base_ptr", "offset")
+
     def __init__(self, base_ptr, offset, reached):
-        super().__init__(None, base_ptr.type, reached)
+        self.value = None
+        self.type = base_ptr.type
+        self.reached = reached
         self.base_ptr = base_ptr
         self.offset = offset
 
     def dependent_ptrs(self):
         return [self.base_ptr]
 
-    def val_string(self):
-        return f"p{self.base_ptr.name}+{self.offset}"
+    def encode_val(self, ids):
+        return ["o", ids.setdefault(self.base_ptr, len(ids)), self.offset]
+
+    def encode_expr(self, ids):
+        return self.encode_val(ids)
+
+
+def update_reached(root):
+    """Propagate `reached` over the pointers reachable from `root`
+
+    A pointer is reached if it or any of its elements is reached, where a
+    pointer element counts as reached if the pointer it refers to is. Pointers
+    may point to each other, so the flag is computed per strongly connected
+    component (iterative Tarjan), in O(V + E) and without recursion.
+    Pointers that are `done` already hold their final flag.
+    """
+    index = {root: 0}
+    low = {root: 0}
+    reached = {root: root.reached}
+    scc_stack = [root]
+    work = [(root, iter(root.value))]
+
+    while work:
+        node, elems = work[-1]
+        for elem in elems:
+            if type(elem) is not PointerValue or elem.done:
+                if elem.reached:
+                    reached[node] = True
+            elif elem not in index:
+                index[elem] = low[elem] = len(index)
+                reached[elem] = elem.reached
+                scc_stack.append(elem)
+                work.append((elem, iter(elem.value)))
+                break
+            else:
+                # On the stack, i.e. in the component being built
+                low[node] = min(low[node], index[elem])
+        else:
+            work.pop()
+            if low[node] == index[node]:
+                members = []
+                while True:
+                    member = scc_stack.pop()
+                    members.append(member)
+                    if member is node:
+                        break
+                scc_reached = any(reached[member] for member in members)
+                for member in members:
+                    member.reached = scc_reached
+                    member.done = True
+
+            if work:
+                parent = work[-1][0]
+                if node.done:
+                    if node.reached:
+                        reached[parent] = True
+                else:
+                    low[parent] = min(low[parent], low[node])
+
 
-    def expr_string(self):
-        return self.val_string()
+# Shared placeholder for unreached primitive values inside structs and arrays
+UNREACHED = PrimitiveValue(None, None, False)
 
 
 def process_context(content):
@@ -158,126 +232,241 @@ def process_context(content):
 
     Args:
         content (string): Raw context string
+
+    Returns:
+        string: Rendered context, or None if the context is malformed
+    """
+    context = encode_context(content)
+    if context is None:
+        return None
+    return render_context(context)
+
+
+def encode_context(content):
+    """Postprocess a raw context into its structured form
+
+    The structured form is a pair of lists: the function arguments and the
+    reached pointers, made of JSON-compatible nodes (see `render_context`).
+    Pointers are numbered in order of first appearance instead of keeping
+    the carver's names, so contexts that only differ in pointer naming
+    encode to the same value.
+
+    Args:
+        content (string): Raw context string
+
+    Returns:
+        list: Structured context, or None if the context is malformed
+    """
+    return encode_context_lines(content.split("\n"))
+
+
+def parse_context_lines(lines):
+    """Parse raw context lines into the list of top-level values
+
+    Args:
+        lines (iterable): Raw context lines
+
+    Returns:
+        list: Parsed function arguments, or None if the context is malformed
     """
-    content = map(lambda x: x.strip(), content.split("\n"))
-    content = filter(lambda x: x != "", content)
     parsed_args = []
 
     unfinished_stack = []  # Save unfinished StructValue or PointerValue line by line
     ptr_to_index = {}  # Pointer length counter for PointerValue objects
     ptr_name2obj = {}  # PointerValue objects indexed by name
+    type_names = {}  # remove_type_prefix results indexed by raw type name
+
+    i = -1
+    for line in lines:
+        line = line.strip()
+        if line == "":
+            continue
+        i += 1
+        reached = line[0] == "%"
+
+        # Fast path: a one-character marker followed by a keyword or a type
+        # and at most one argument, all separated by single spaces. Lines are
+        # only classified here when the generic path below would classify
+        # them the same way.
+        toks = line.split(" ")
+        num_toks = len(toks)
+        kind = toks[1] if len(toks[0]) == 1 and 1 < num_toks < 4 else ""
+        if num_toks == 3:
+            arg = toks[2]
+            if kind in PTR_KEYWORDS:
+                if not arg.isdigit():
+                    kind = ""
+            elif (
+                kind.startswith(PRIMITIVE_PREFIX)
+                and "+" not in line
+                and not arg.endswith("]")
+            ):
+                raw_type = kind
+                kind = "PRIMITIVE"
+            else:
+                kind = ""
+        elif kind != "STRUCT_BEGIN" and kind != "STRUCT_END":
+            kind = ""
+
+        if kind == "":
+            expr = line[2:].strip()
+            # Array type
+            if expr.endswith("]"):
+                kind = "ARRAY"
+            # Pointer with offset
+            elif "+" in expr:
+                kind = "OFFSET"
+            elif expr.startswith(PTR_KEYWORDS):
+                kind = next(k for k in PTR_KEYWORDS if expr.startswith(k))
+                arg = expr.split(" ")[1]
+            elif expr.startswith("STRUCT_BEGIN"):
+                kind = "STRUCT_BEGIN"
+            elif expr.startswith("STRUCT_END"):
+                kind = "STRUCT_END"
+            elif expr.startswith(PRIMITIVE_PREFIX):
+                kind = "PRIMITIVE"
+                space_pos = expr.find(" ")
+                raw_type = expr[:space_pos]
+                arg = expr[space_pos + 1 :]
+            else:
+                rich.print(f"[red]Unknown expression: {expr} (Line {i + 1})[/red]")
+                return None
 
-    for i, expr in enumerate(content):
-        reached = expr[0]
-        expr = expr[2:].strip()
-        reached = reached == "%"
-        # Array type
-        if expr.endswith("]"):
+        if kind == "PRIMITIVE":
+            if not reached and unfinished_stack:
+                # Unreached values inside an object are never printed
+                value = UNREACHED
+            else:
+                primitive_type = type_names.get(raw_type)
+                if primitive_type is None:
+                    primitive_type = remove_type_prefix(raw_type)
+                    type_names[raw_type] = primitive_type
+                if arg == "?":
+                    arg = "unknown"
+                value = PrimitiveValue(arg, primitive_type, reached)
+        elif kind == "PTR_IDX":
+            ptr_index = int(arg)
+            cur_ptr = unfinished_stack[-1] if unfinished_stack else None
+            if type(cur_ptr) is not PointerValue:
+                cur_ptr = None
+                for obj in reversed(unfinished_stack):
+                    if type(obj) is PointerValue:
+                        cur_ptr = obj
+                        break
+            elems = cur_ptr.value
+            missing = ptr_index + 1 - len(elems)
+            if missing > 0:
+                elems.extend([None] * missing)
+            ptr_to_index[cur_ptr] = ptr_index
+            continue
+        elif kind == "STRUCT_BEGIN":
+            struct_type = unfinished_stack[-1].type
+            unfinished_stack.append(StructValue(struct_type, reached))
+            continue
+        elif kind == "STRUCT_END":
+            value = unfinished_stack.pop()
+            # assert isinstance(value, StructValue)
+            if type(value) is not StructValue:
+                rich.print(f"[red]STRUCT_END in wrong place (Line {i + 1})[/red]")
+                return None
+        # open PTR_BEGIN
+        elif kind == "PTR_BEGIN":
+            ptr_name = int(arg)
+            unfinished_stack.append(ptr_name2obj[ptr_name])
+            continue
+        elif kind == "PTR_END":
+            ptr_name = int(arg)
+            ptr_obj = ptr_name2obj[ptr_name]
+            assert unfinished_stack.pop() == ptr_obj
+            ptr_to_index.pop(ptr_obj)
+            continue
+        elif kind == "ARRAY":
             space_pos = expr.find(" ")
             bracket_open_pos = expr.find("[")
             bracket_close_pos = expr.find("]")
             array_type = expr[:space_pos]
             array_name = int(expr[space_pos + 2 : bracket_open_pos])  # " pN[...]"
             alloc_size = int(expr[bracket_open_pos + 1 : bracket_close_pos])
-            if array_name not in ptr_name2obj:
+            value = ptr_name2obj.get(array_name)
+            if value is None:
                 value = PointerValue(array_type, alloc_size, array_name, reached)
                 ptr_name2obj[array_name] = value
             else:
-                value = ptr_name2obj[array_name]
                 assert value.type == array_type
                 value.alloc_size = alloc_size
                 value.reached = reached or value.reached
-        # Pointer with offset
-        elif "+" in expr:
+        else:
+            # OFFSET
             expr, offset = expr.split("+")
             baseptr_index = int(expr[expr.rfind("*") + 2 :])
-            baseptr_type = expr[: expr.rfind("*") - 1]
-            if baseptr_index in ptr_name2obj:
-                value = PointerOffsetValue(ptr_name2obj[baseptr_index], offset, reached)
-            else:
+            baseptr_obj = ptr_name2obj.get(baseptr_index)
+            if baseptr_obj is None:
                 baseptr_obj = PointerValue(array_type, None, baseptr_index, reached)
                 ptr_name2obj[baseptr_index] = baseptr_obj
-                value = PointerOffsetValue(baseptr_obj, offset, reached)
-        # open PTR_BEGIN
-        elif expr.startswith("PTR_BEGIN"):
-            value = None
-            ptr_name = int(expr.split(" ")[1])
-            unfinished_stack.append(ptr_name2obj[ptr_name])
-        elif expr.startswith("PTR_END"):
-            value = None
-            ptr_name = int(expr.split(" ")[1])
-            ptr_obj = ptr_name2obj[ptr_name]
-            assert unfinished_stack.pop() == ptr_obj
-            ptr_to_index.pop(ptr_obj)
-        elif expr.startswith("PTR_IDX"):
-            value = None
-            ptr_index = int(expr.split(" ")[1])
-            cur_ptr = None
-            for obj in reversed(unfinished_stack):
-                if isinstance(obj, PointerValue):
-                    cur_ptr = obj
-                    break
-            while len(cur_ptr.value) < ptr_index + 1:
-                cur_ptr.value.append(None)
-            ptr_to_index[cur_ptr] = ptr_index
-        elif expr.startswith("STRUCT_BEGIN"):
-            value = None
-            struct_type = unfinished_stack[-1].type
-            unfinished_stack.append(StructValue(struct_type, reached))
-        elif expr.startswith("STRUCT_END"):
-            value = unfinished_stack.pop()
-            # assert isinstance(value, StructValue)
-            if not isinstance(value, StructValue):
-                rich.print(f"[red]STRUCT_END in wrong place (Line {i + 1})[/red]")
-                return None
-        # primitive type
-        elif re.match(
-            r"^(i8|i16|i32|i64|f32|f64|func|struct|%struct|class|union)", expr
-        ):
-            space_pos = expr.find(" ")
-            primitive_type = remove_type_prefix(expr[:space_pos])
-            primitive_val = expr[space_pos + 1 :]
-            if primitive_val == "?":
-                primitive_val = "unknown"
-            value = PrimitiveValue(primitive_val, primitive_type, reached)
-        else:
-            rich.print(f"[red]Unknown expression: {expr} (Line {i + 1})[/red]")
-            return None
+            value = PointerOffsetValue(baseptr_obj, offset, reached)
 
-        if value is None:
-            # Value is stacked to unfinished_stack (e.g. PTR_BEGIN, STRUCT_BEGIN)
-            continue
-        else:
-            # If the stacks are not empty, add to the top of the stack
-            if len(unfinished_stack) > 0:
-                last_val = unfinished_stack[-1]
-                if isinstance(last_val, StructValue):
-                    last_val.append(value)
-                elif isinstance(last_val, PointerValue):
-                    try:
-                        ptr_index = ptr_to_index[last_val]
-                    except KeyError:
-                        rich.print(
-                            f"[red]PTR_IDX not found for {last_val} (Line {i+1})[/red]"
-                        )
-                        return None
-                    last_val.value[ptr_index] = value
+        # If the stacks are not empty, add to the top of the stack
+        if unfinished_stack:
+            last_val = unfinished_stack[-1]
+            if type(last_val) is StructValue:
+                last_val.value.append(value)
             else:
-                parsed_args.append(value)
+                try:
+                    ptr_index = ptr_to_index[last_val]
+                except KeyError:
+                    rich.print(
+                        f"[red]PTR_IDX not found for {last_val} (Line {i+1})[/red]"
+                    )
+                    return None
+                last_val.value[ptr_index] = value
+        else:
+            parsed_args.append(value)
+
+    return parsed_args
+
+
+def encode_carve_file(carve_file):
+    """Postprocess a carve output file, see `encode_context`
+
+    Lines are streamed from a buffered reader into the parser, so the raw
+    context is never held in memory as a whole.
+
+    Args:
+        carve_file (Path): Carve output file
+    """
+    with open(carve_file) as f:
+        return encode_context_lines(f)
+
+
+def encode_context_lines(lines):
+    """Postprocess raw context lines, see `encode_context`"""
+    # The value graph only grows while parsing, so the cyclic garbage
+    # collector would rescan it again and again without freeing anything.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        parsed_args = parse_context_lines(lines)
+        if parsed_args is None:
+            return None
+        return _encode_args(parsed_args)
+    finally:
+        if gc_enabled:
+            gc.enable()
 
-    to_process = Queue()
-    for arg in parsed_args:
-        to_process.put(arg)
 
-    to_process.put(None)
+def _encode_args(parsed_args):
+    to_process = deque(parsed_args)
+    to_process.append(None)
 
-    new_content = []
+    args = []
+    ptrs = []
+    ids = {}  # Canonical pointer numbers indexed by PointerValue objects
     processed = set()  # Set of visited PointerValue objects
 
     meet_none = False
 
-    while not to_process.empty():
-        cur = to_process.get()
+    while to_process:
+        cur = to_process.popleft()
         if cur is not None:
             if isinstance(cur, PointerValue):
                 if cur in processed:
@@ -287,21 +476,155 @@ def process_context(content):
                     if not cur.done:
                         cur.reach_update()
 
-            if not meet_none or cur.reached:
-                new_content.append(cur.expr_string())
+            if not meet_none:
+                args.append(cur.encode_expr(ids))
+            elif cur.reached:
+                ptrs.append(cur.encode_expr(ids))
 
             for ptr_obj in cur.dependent_ptrs():
                 if ptr_obj not in processed:
-                    to_process.put(ptr_obj)
+                    to_process.append(ptr_obj)
         else:
-            meet_none = True
             # Function argument separator
-            new_content.append("")
+            meet_none = True
+
+    return [args, ptrs]
+
+
+def _render_val(node):
+    if isinstance(node, str):
+        return node
+    elif node[0] == "p":
+        return f"p{node[1]}"
+    elif node[0] == "o":
+        return f"p{node[1]}+{node[2]}"
+    else:
+        # Struct
+        return "{" + ", ".join(f"{i}:{_render_val(val)}" for i, val in node[1]) + "}"
+
+
+def _render_expr(node):
+    kind = node[0]
+    if kind == "v":
+        return f"{node[1]} {node[2]}"
+    elif kind == "P":
+        _, name, type_str, length, elems = node
+        if elems == []:
+            return f"{type_str} p{name}[{length}]"
+        value_str = ", ".join(f"{i}:{_render_val(val)}" for i, val in elems)
+        return f"{type_str} p{name}[{length}] = [{value_str}]"
+    elif kind == "S":
+        inner = "{" + ", ".join(f"{i}:{_render_expr(val)}" for i, val in node[2]) + "}"
+        return f"{node[1]} {inner}"
+    else:
+        # Pointer or pointer with offset in a struct field
+        return _render_val(node)
+
+
+def render_context(context):
+    """Render a structured context as text, one expression per line
+
+    Function arguments come first, then the reached pointers after an empty
+    line.
+    """
+    args, ptrs = context
+    lines = [_render_expr(node) for node in args]
+    if ptrs:
+        lines.append("")
+        lines.extend(_render_expr(node) for node in ptrs)
+    return "\n".join(lines)
 
-    if new_content[-1] == "":
-        new_content.pop()
 
-    return "\n".join(new_content)
+def dump_context(context):
+    """Canonical byte encoding of a structured context, used for hashing"""
+    return json.dumps(context, separators=(",", ":"), ensure_ascii=False).encode(
+        "utf-8"
+    )
+
+
+def pack_context(data):
+    """Compress the output of `dump_context` for storage"""
+    return zlib.compress(data)
+
+
+def load_context(blob):
+    """Inverse of `pack_context`"""
+    return json.loads(zlib.decompress(blob))
+
+
+def file_digest(path):
+    """Hex digest of the content of a file"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class CarvingCache:
+    """Carved contexts indexed by carver binary and input content
+
+    An entry is a directory `<binary digest>/<input digest>`. Its `.reached`
+    file lists the functions carved from the input, and marks the entry as
+    complete: a function that is not listed was not reached by the input.
+    The packed `dump_context` output of a function is stored in a file of
+    the same name once a unit has parsed it, so other units sharing the
+    carver only carve the input again for their own function.
+
+    Args:
+        cache_dir (Path): Cache directory
+        binary (Path): Carver binary
+    """
+
+    def __init__(self, cache_dir, binary):
+        self.dir = Path(cache_dir) / file_digest(binary)
+        self.dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, testcase):
+        return file_digest(testcase)
+
+    def get(self, key, function):
+        """Look up the context of `function` carved from an input
+
+        Returns:
+            tuple: (hit, data) where data is the `dump_context` output, or
+            None if the function was not reached
+        """
+        entry = self.dir / key
+        context_file = entry / function
+        if context_file.exists():
+            return True, zlib.decompress(context_file.read_bytes())
+        try:
+            reached = (entry / ".reached").read_text().split("\n")
+        except OSError:
+            return False, None
+        # Reached but not parsed yet
+        return function not in reached, None
+
+    def _write(self, path, content):
+        # Written to a temporary file and renamed, so that concurrent workers
+        # never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=path.parent)
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+    def put(self, key, reached, function, data):
+        """Store the context of `function` carved from an input
+
+        Args:
+            key (string): Output of `key`
+            reached (set): Functions carved from the input
+            function (string): Function name
+            data (bytes): `dump_context` output, or None if the function was
+                not reached or its context could not be parsed
+        """
+        entry = self.dir / key
+        entry.mkdir(exist_ok=True)
+        if data is not None:
+            self._write(entry / function, pack_context(data))
+        if not (entry / ".reached").exists():
+            self._write(entry / ".reached", "\n".join(sorted(reached)).encode())
 
 
 def parse_carve_filename(testcase_name):
@@ -4,15 +4,18 @@ import tempfile
 from pathlib import Path
 
 import pandas as pd
-import pathos
 import rich
 from tqdm import tqdm
 
-from carve_common import parse_carve_filename, process_context
-from config import (CARVING_LLVM, LIBFUZZER_DRIVER, PIN, corpus_dir,
-                    create_connection)
+from carve_common import (dump_context, encode_carve_file, load_context,
+                          pack_context, parse_carve_filename, render_context)
+from admission import AdmissionPool
+from config import CARVING_LLVM, LIBFUZZER_DRIVER, PIN, corpus_dir
 from project_base import Project
-from utils import check_call, get_cmd
+from storage import (carving_writer, context_hash, fetch_all, is_new_context,
+                     load_dedup)
+from unit_prioritization import parse_symbol_file
+from utils import check_call, get_cmd, select_max_coverage
 
 
 class SystemCarvingTestCase:
@@ -57,28 +60,33 @@ class SystemCarvingTestCase:
                     stderr=subprocess.DEVNULL,
                 )
                 if save:
-                    for carve_file in Path(out_dir).glob("*"):
-                        carve_name = carve_file.name
-                        carved_function, _ = parse_carve_filename(carve_name)
-                        content = carve_file.read_text()
-                        content = process_context(content)
-                        if content is None:
-                            rich.print(
-                                f"[red]Exception while carving {self.name}\n{carve_file}[/red]"
+                    with carving_writer(table_name) as writer:
+                        for carve_file in Path(out_dir.name).glob("*"):
+                            carve_name = carve_file.name
+                            carved_function, _ = parse_carve_filename(carve_name)
+                            context = encode_carve_file(carve_file)
+                            if context is None:
+                                rich.print(
+                                    f"[red]Exception while carving {self.name}\n{carve_file}[/red]"
+                                )
+                                continue
+
+                            data = dump_context(context)
+                            content_hash = context_hash(data)
+                            if not is_new_context(
+                                table_name,
+                                self.project.name,
+                                (carved_function, content_hash),
+                            ):
+                                continue
+                            writer.add(
+                                (
+                                    self.project.name,
+                                    carved_function,
+                                    pack_context(data),
+                                    content_hash,
+                                )
                             )
-                            continue
-
-                        conn = create_connection()
-                        cursor = conn.cursor()
-                        cursor.execute(
-                            "INSERT INTO {} (project, function_name, context, context_hash) values (%s, %s, %s, hashtextextended(%s, 0)) ON CONFLICT DO NOTHING".format(
-                                table_name
-                            ),
-                            (self.project.name, carved_function, content, content),
-                        )
-                        conn.commit()
-                        cursor.close()
-                        conn.close()
 
             except subprocess.TimeoutExpired:
                 rich.print(f"[red]Timeout while carving {self.name}[/red]")
@@ -91,6 +99,8 @@ class SystemCarving(Project):
         super().__init__(name, version, tag)
         self.base_bin = self.bin
         self.bin = self.base_bin.with_suffix(".carve")
+        # Output of UnitPrioritization.callseq_analysis on the same build
+        self.funcseq_out = self.out_dir / "funcseq"
 
     def build(self, debug=False):
         assert self.base_bin.exists()
@@ -124,6 +134,56 @@ class SystemCarving(Project):
         check_call(opt_cmd, cwd=self.out_dir)
         check_call(comp_cmd, cwd=self.out_dir)
 
+    def select_corpus(self, corpus, limit):
+        """Select corpus files that reach the target functions
+
+        Uses the functions hit by each testcase during callseq analysis.
+        Testcases are picked greedily by the number of new (target function,
+        hit function) pairs they cover, so that inputs reaching a target
+        through different call contexts come first. The rest of the budget
+        is filled with other inputs reaching a target.
+
+        Args:
+            corpus (list): Corpus files
+            limit (int): Maximum number of files to select
+
+        Returns:
+            list: Selected files, or None if there is no callseq data
+        """
+        target = Path.cwd() / "data" / self.name / "target.txt"
+        targets = set(filter(lambda x: x != "", target.read_text().split("\n")))
+
+        features = {}
+        has_data = False
+        for testcase in corpus:
+            symbol_file = self.funcseq_out / (testcase.name + ".symbol")
+            if not symbol_file.exists():
+                continue
+            symbols = parse_symbol_file(symbol_file)
+            if symbols is None:
+                continue
+            has_data = True
+            functions = {function for _, function in symbols}
+            hit = functions & targets
+            if hit:
+                features[testcase] = {(t, f) for t in hit for f in functions}
+
+        if not has_data:
+            return None
+
+        rich.print(
+            f"[green]{len(features)} / {len(corpus)} testcases reach target functions"
+        )
+
+        if limit is None:
+            limit = len(features)
+
+        selected = select_max_coverage(features, limit)
+        selected_set = set(selected)
+        rest = [t for t in features if t not in selected_set]
+        random.shuffle(rest)
+        return selected + rest[: limit - len(selected)]
+
     def run(
         self,
         limit=20000,
@@ -132,16 +192,32 @@ class SystemCarving(Project):
         target=None,
         parallel=True,
         raw=False,
+        bloom=False,
+        select=False,
     ):
         assert self.bin.exists()
         if target is None:
             corpus = list(corpus_dir(self.name).iterdir())
-            if limit is not None and len(corpus) > limit:
-                corpus = random.sample(corpus, limit)
+            selected = self.select_corpus(corpus, limit) if select else None
+            if selected is not None:
+                corpus = selected
+            else:
+                if select:
+                    rich.print(
+                        f"[red]No callseq data in {self.funcseq_out}, sampling randomly"
+                    )
+                if limit is not None and len(corpus) > limit:
+                    corpus = random.sample(corpus, limit)
         else:
             corpus = target
 
+        table_name = "system_carving_raw" if raw else "system_carving"
+        load_dedup(
+            table_name, self.name, ["function_name", "context_hash"], bloom=bloom
+        )
+
         def carve_and_postprocess(testcase):
+            rows = []
             if not debug:
                 _out_dir = tempfile.TemporaryDirectory()
                 out_dir = Path(_out_dir.name)
@@ -173,67 +249,87 @@ class SystemCarving(Project):
                     for carve_file in Path(out_dir).glob("*"):
                         carve_name = carve_file.name
                         carved_function, _ = parse_carve_filename(carve_name)
-                        content = carve_file.read_text()
-
-                        if not raw:
-                            content = process_context(content)
-                            if content is None:
+                        if raw:
+                            content = carve_file.read_text()
+                            content_hash = context_hash(content)
+                        else:
+                            context = encode_carve_file(carve_file)
+                            if context is None:
                                 rich.print(
                                     f"[red]Exception while carving {testcase}\n{carve_file}[/red]"
                                 )
                                 if debug:
                                     input()
                                 continue
+                            data = dump_context(context)
+                            content_hash = context_hash(data)
+                            content = pack_context(data)
 
-                        conn = create_connection()
-                        cursor = conn.cursor()
                         if debug:
-                            (out_dir / f"{carve_name}.processed").write_text(content)
-                        cursor.execute(
-                            "INSERT INTO {} (project, function_name, context, context_hash) values (%s, %s, %s, hashtextextended(%s, 0)) ON CONFLICT DO NOTHING".format(
-                                "system_carving_raw" if raw else "system_carving"
-                            ),
-                            (self.name, carved_function, content, content),
-                        )
-                        conn.commit()
-                        cursor.close()
-                        conn.close()
+                            (out_dir / f"{carve_name}.processed").write_text(
+                                render_context(context) if not raw else content
+                            )
+
+                        rows.append((self.name, carved_function, content, content_hash))
                 except subprocess.TimeoutExpired:
                     rich.print(f"[red]Timeout while carving {testcase}")
             if not debug:
                 _out_dir.cleanup()
+            return rows
 
-        if parallel:
-            with pathos.helpers.mp.Pool() as pool:
-                for _ in tqdm(
-                    pool.imap_unordered(carve_and_postprocess, corpus),
-                    total=len(corpus),
-                ):
-                    pass
-        else:
-            for testcase in tqdm(corpus):
-                carve_and_postprocess(testcase)
+        def new_rows(rows):
+            # Drop contexts already stored or carved from another testcase
+            return [
+                row
+                for row in rows
+                if is_new_context(table_name, self.name, (row[1], row[3]))
+            ]
+
+        # Rows are sent back to this process, deduplicated across workers and
+        # inserted in batches
+        with carving_writer(table_name) as writer:
+            if parallel:
+                with AdmissionPool("system_carving", self.name) as pool:
+                    for rows in tqdm(
+                        pool.imap_unordered(carve_and_postprocess, corpus),
+                        total=len(corpus),
+                    ):
+                        writer.extend(new_rows(rows))
+            else:
+                for testcase in tqdm(corpus):
+                    writer.extend(new_rows(carve_and_postprocess(testcase)))
 
     def get(self, function_name):
-        conn = create_connection()
-        cursor = conn.cursor()
-        cursor.execute(
+        rows = fetch_all(
             "SELECT context FROM system_carving WHERE project = %s AND function_name = %s",
             (self.name, function_name),
         )
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return rows
+        return [render_context(load_context(bytes(row[0]))) for row in rows]
+
+    def count(self):
+        """Number of carved contexts of each function in this project
+
+        Read from `system_carving_count`, which is kept up to date by a
+        trigger on `system_carving`, so no context row is scanned.
+
+        Returns:
+            dict: Count of each function name
+        """
+        rows = fetch_all(
+            "SELECT function_name, count FROM system_carving_count WHERE project = %s",
+            (self.name,),
+        )
+        return dict(rows)
 
     def count_system_testcases(self, units):
+        counts = self.count()
         res = []
         for u in units:
             function_name = u.function
             res.append(
                 {
                     "Function": function_name,
-                    "# of carved testcases": len(self.get(function_name)),
+                    "# of carved testcases": counts.get(function_name, 0),
                 }
             )
 
@@ -12,6 +12,48 @@ def create_connection():
     return psycopg2.connect(user=username, password=password, host=host, port=5432)
 
 
+# Storage backend of carving and triage results: "postgres" or "sqlite"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "postgres")
+SQLITE_DB = Path(
+    os.environ.get("SQLITE_DB", Path.cwd() / "data" / "regression_unit.sqlite")
+)
+# Source snapshots of the artifacts, shared by all build tags
+SNAPSHOT_DIR = Path.cwd() / "build" / "snapshot"
+# Without reflinks, build tags share the snapshot files through hard links,
+# and the snapshot is made read-only. SNAPSHOT_LINKS=0 makes full copies.
+SNAPSHOT_LINKS = os.environ.get("SNAPSHOT_LINKS", "1") == "1"
+
+# Compiler cache shared by all versions and tags, disabled with COMPILER_CACHE=0
+COMPILER_CACHE = os.environ.get("COMPILER_CACHE", "1") == "1"
+COMPILER_CACHE_DIR = Path.cwd() / "build" / "ccache"
+
+# Admission control of parallel jobs (see admission.AdmissionPool). Budgets
+# default to all CPUs and 90% of the physical memory.
+CPU_BUDGET = int(os.environ.get("CPU_BUDGET", os.cpu_count()))
+MEMORY_BUDGET = int(
+    os.environ.get(
+        "MEMORY_BUDGET",
+        os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 0.9 // (1 << 20),
+    )
+)
+# Memory estimate of a job in MiB until a peak is learned
+JOB_MEMORY = {
+    "default": 1024,
+    "unit_fuzz": 1024,
+    "unit_carving": 2048,
+    "system_fuzz": 1024,
+    "system_carving": 4096,
+    "callseq": 512,
+    "triage": 1024,
+}
+JOB_MEMORY_FILE = Path.cwd() / "data" / "job_memory.json"
+# Delegated cgroup v2 directory, per-job memory limits are enforced if set
+ADMISSION_CGROUP = os.environ.get("ADMISSION_CGROUP")
+
+# Contexts carved by unit carving, reused across repeats and reruns
+CARVE_CACHE = Path(os.environ.get("CARVE_CACHE", Path.cwd() / "data" / "carve_cache"))
+
+
 # Path to bugoss-fuzz
 CROWN_HARNESS_GENERATOR = (
     Path.cwd() / "tools" / "crown_harness_generator" / "crown_harness_generator"
@@ -24,8 +66,11 @@ RUN_CROWN = CROWN_TC_GENERATOR / "bin" / "run_crown"
 LIBFUZZER_DRIVER = Path.cwd() / "libfuzzer" / "libfuzzer.a"
 AFLCC = Path.cwd() / "tools" / "AFLplusplus" / "afl-clang-lto"
 AFL_FUZZ = Path.cwd() / "tools" / "AFLplusplus" / "afl-fuzz"
+AFL_SHOWMAP = Path.cwd() / "tools" / "AFLplusplus" / "afl-showmap"
 PRINT_FUNCTION = Path.cwd() / "tools" / "print_function" / "lib"
 PIN = CARVING_LLVM / "pin" / "pin"
+# gcov-compatible tool for the counters of `Project.build_coverage` (clang)
+GCOV = ["llvm-cov", "gcov"]
 
 
 def corpus_dir(project_name):
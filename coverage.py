@@ -1,10 +1,15 @@
+import fcntl
 import glob
 import os
 import random
+import select
 import subprocess
+import tempfile
 from collections import Counter
+from multiprocessing import shared_memory
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import pathos
 import rich
@@ -16,12 +21,16 @@ from utils import get_cmd
 
 BB_COV_DIR = ""  # TODO
 
+# SanitizerCoverage runtime of the shared-memory mode, see `ShmCoverageRunner`
+SHM_COV_RT = Path(__file__).parent / "assets" / "shm_cov_rt.c"
+
 
 class Coverage(Project):
     def __init__(self, name, version, tag=None):
         super().__init__(name, version, tag)
         self.base_bin = self.bin
         self.bin = self.base_bin.with_suffix(".cov")
+        self.shm_bin = self.base_bin.with_suffix(".shmcov")
 
     def build(self):
         assert self.base_bin.exists()
@@ -54,8 +63,97 @@ class Coverage(Project):
         subprocess.check_call(opt_cmd, env=env)
         subprocess.check_call(compile_cmd, env=env)
 
+    def build_shm(self):
+        """Build the binary of the shared-memory coverage mode
+
+        The program is instrumented with SanitizerCoverage 8-bit counters and
+        linked with `assets/shm_cov_rt.c`, which replaces the libFuzzer
+        driver with a loop over inputs read from stdin. The bitcode of the
+        gllvm build already holds the `main` of the driver, so that one is
+        weakened and the `main` of the runtime is linked instead.
+        """
+        assert self.base_bin.exists()
+        env = os.environ.copy()
+        get_bc_cmd = ["get-bc", "-o", f"{self.base_bin}.bc", self.base_bin]
+        rt_cmd = [
+            "clang",
+            "-c",
+            "-O2",
+            SHM_COV_RT,
+            "-o",
+            f"{self.shm_bin}.rt.o",
+        ]
+        instrument_cmd = [
+            "clang",
+            "-c",
+            "-fsanitize-coverage=inline-8bit-counters,pc-table",
+            f"{self.base_bin}.bc",
+            "-o",
+            f"{self.shm_bin}.o",
+        ]
+        weaken_cmd = ["objcopy", "--weaken-symbol=main", f"{self.shm_bin}.o"]
+        compile_cmd = [
+            "clang++",
+            f"{self.shm_bin}.o",
+            f"{self.shm_bin}.rt.o",
+            "-o",
+            self.shm_bin,
+            "-ldl",
+            "-lrt",
+        ] + self.fuzzer_libs
+
+        rich.print(f"[green]{get_cmd(compile_cmd)}")
+
+        subprocess.check_call(get_bc_cmd, env=env)
+        subprocess.check_call(rt_cmd, env=env)
+        subprocess.check_call(instrument_cmd, env=env)
+        subprocess.check_call(weaken_cmd, env=env)
+        subprocess.check_call(compile_cmd, env=env)
+
     def run(self, testcase, timeout):
-        try:
+        """Run a testcase and parse its coverage
+
+        The bb-cov runtime writes the .cov file of each source file next to
+        it in `src_project_dir`. Each run mounts an overlay of the source tree
+        in its own mount namespace, so that its files land in a private upper
+        directory and runs of the same binary proceed in parallel. Without
+        unprivileged namespaces, runs of a binary hold a lock on the source
+        tree from the cleanup of the previous files until the new ones are
+        parsed.
+
+        Returns:
+            dict: Coverage of each source file, see `parse_cov_files`, or
+            None if the run timed out or wrote no coverage
+        """
+        if not overlay_supported():
+            return self._run_locked(testcase, timeout)
+
+        with tempfile.TemporaryDirectory() as run_dir:
+            upper = Path(run_dir) / "upper"
+            work = Path(run_dir) / "work"
+            upper.mkdir()
+            work.mkdir()
+            try:
+                subprocess.run(
+                    overlay_cmd(self.src_project_dir, upper, work)
+                    + [self.bin, testcase],
+                    timeout=timeout,
+                    stderr=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                )
+            except subprocess.TimeoutExpired:
+                rich.print(f"[red]Test case {testcase.name} timed out")
+                return None
+            finally:
+                # Left without permissions by overlayfs
+                for path in work.iterdir():
+                    path.chmod(0o700)
+
+            return parse_cov_files(upper)
+
+    def _run_locked(self, testcase, timeout):
+        with open(self.src_project_dir / ".cov.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
             # Remove all .cov files recursively in the directory `src_project_dir`
             subprocess.run(
                 ["find", ".", "-name", "*.cov", "-delete"],
@@ -63,45 +161,111 @@ class Coverage(Project):
                 stdout=subprocess.DEVNULL,
                 stderr=subprocess.DEVNULL,
             )
-            subprocess.run(
-                [self.bin, testcase],
-                timeout=timeout,
-                stderr=subprocess.DEVNULL,
+            try:
+                subprocess.run(
+                    [self.bin, testcase],
+                    timeout=timeout,
+                    stderr=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                )
+            except subprocess.TimeoutExpired:
+                rich.print(f"[red]Test case {testcase.name} timed out")
+                return None
+
+            return parse_cov_files(self.src_project_dir)
+
+
+def overlay_cmd(lower, upper, work):
+    """Prefix of a command that runs with `upper` mounted over `lower`
+
+    The overlay is mounted in a new user and mount namespace, so it needs no
+    privileges and is only seen by the command. Files written under `lower`
+    go to `upper`, at the same relative path.
+    """
+    script = (
+        'mount -t overlay overlay -o "lowerdir=$1,upperdir=$2,workdir=$3" "$1" '
+        '&& shift 3 && exec "$@"'
+    )
+    return [
+        "unshare",
+        "--user",
+        "--map-root-user",
+        "--mount",
+        "sh",
+        "-c",
+        script,
+        "sh",
+        str(lower),
+        str(upper),
+        str(work),
+    ]
+
+
+# Whether unprivileged overlay mounts work, checked on first use
+_overlay_supported = None
+
+
+def overlay_supported():
+    global _overlay_supported
+    if _overlay_supported is None:
+        with tempfile.TemporaryDirectory() as tmp:
+            dirs = [Path(tmp) / name for name in ("lower", "upper", "work")]
+            for path in dirs:
+                path.mkdir()
+            out = subprocess.run(
+                overlay_cmd(*dirs) + ["true"],
                 stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
             )
-            return 0
-        except subprocess.TimeoutExpired:
-            rich.print(f"[red]Test case {testcase.name} timed out")
-            return 1
+            for path in dirs[2].iterdir():
+                path.chmod(0o700)
+        _overlay_supported = out.returncode == 0
+        if not _overlay_supported:
+            rich.print(
+                "[red]Unprivileged overlay mounts are not available, coverage "
+                "runs of a binary are serialized"
+            )
+    return _overlay_supported
 
 
 def parse_cov_file(cov_file):
-    result = {}
+    """Parse the .cov file of a source file
 
-    cur_func = None
+    Returns:
+        tuple: (function name, basic block count) of each function in file
+        order, and the covered flag of every basic block of the file as a
+        bool array, functions laid out one after the other
+    """
+    functions = []
+    covered = []
+
+    offset = 0
+    bb_count = 0
 
     with open(cov_file, "r") as f:
         for line in f:
+            line = line.strip()
             if line == "":
                 continue
 
-            line = line.strip()
             if line[0] == "F":
+                offset += bb_count
                 line = line[2:]
                 last_space = line.rfind(" ")
-                covered = line[last_space + 1 :]
                 line = line[:last_space]
                 last_space = line.rfind(" ")
-                bb_count = line[last_space + 1 :]
-                cur_func = line[:last_space]
-                result[cur_func] = [False] * int(bb_count)
+                bb_count = int(line[last_space + 1 :])
+                functions.append((line[:last_space], bb_count))
             else:
-                _, bb_index, covered = line.split(" ")
-                if covered != "0" and covered != "1":
+                _, bb_index, flag = line.split(" ")
+                if flag == "1":
+                    covered.append(offset + int(bb_index))
+                elif flag != "0":
                     raise Exception("Invalid coverage file")
-                result[cur_func][int(bb_index)] = covered == "1"
 
-    return result
+    bits = np.zeros(offset + bb_count, dtype=bool)
+    bits[covered] = True
+    return functions, bits
 
 
 def parse_cov_files(cov_dir):
@@ -118,53 +282,302 @@ def parse_cov_files(cov_dir):
     return result
 
 
-def run_and_compare(before_conf, after_conf, testcase, timeout):
-    def run_single(conf):
-        # todo
-        return_code = conf.run(testcase, timeout)
-        if return_code:
-            return None
+def run_cov(conf, testcase, timeout):
+    """Coverage of a testcase, see `parse_cov_files`"""
+    return conf.run(testcase, timeout)
+
+
+class ShmCoverageRunner:
+    """Persistent process of a `.shmcov` binary
 
-        cov = parse_cov_files(conf.src_project_dir)
-        if cov is None:
+    Inputs are sent one at a time to a single process, which resets its
+    counters before each input and copies them to shared memory after it.
+    The counters are read in place, and grouped by source file and function
+    with the same structure as `parse_cov_files`, so that `diff_cov` and
+    `CoverageLayout` apply unchanged. File names are relative to
+    `src_project_dir`.
+
+    A process that crashes or times out is restarted for the next input. An
+    input that cannot be read is reported and skipped.
+
+    Args:
+        conf (Coverage): Project configuration
+        timeout (int): Timeout of each input in seconds
+    """
+
+    def __init__(self, conf, timeout=None):
+        self.conf = conf
+        self.timeout = timeout
+        self.proc = None
+        self.shm = None
+        self.index = None
+
+    def start(self):
+        self.name = f"shmcov_{os.getpid()}_{id(self)}"
+        env = os.environ.copy()
+        env["SHM_COV_NAME"] = self.name
+        self.proc = subprocess.Popen(
+            [self.conf.shm_bin],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=env,
+            cwd=self.conf.src_project_dir,
+            text=True,
+        )
+        ready = self.proc.stdout.readline().split()
+        if len(ready) != 2 or ready[0] != "ready":
+            raise RuntimeError(f"Cannot start {self.conf.shm_bin}")
+        n = int(ready[1])
+        self.shm = shared_memory.SharedMemory(name=self.name)
+        # The mapping stays valid, and nothing is left behind if we crash
+        self.shm.unlink()
+        self.counters = np.ndarray((n,), dtype=np.uint8, buffer=self.shm.buf, offset=16)
+        if self.index is None:
+            padded = (n + 7) // 8 * 8
+            table = np.ndarray(
+                (2, n), dtype=np.uint64, buffer=self.shm.buf, offset=16 + padded
+            )
+            self.index = self._symbolize(table[0].copy(), table[1].copy())
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+        if self.shm is not None:
+            self.counters = None
+            self.shm.close()
+            self.shm = None
+
+    def _symbolize(self, pcs, flags):
+        """Source file and function of each counter
+
+        Counters of a function are contiguous and start at its entry block,
+        so only the entry blocks are symbolized.
+
+        Returns:
+            list: (filename, [(function name, block count)], counter indices)
+            of each source file
+        """
+        entries = np.flatnonzero(flags & 1)
+        out = subprocess.run(
+            ["llvm-symbolizer", "--no-inlines", f"--obj={self.conf.shm_bin}"],
+            input="\n".join(hex(int(pcs[i])) for i in entries),
+            capture_output=True,
+            text=True,
+        ).stdout
+        frames = [frame.split("\n") for frame in out.strip().split("\n\n")]
+
+        root = str(self.conf.src_project_dir) + "/"
+        ends = list(entries[1:]) + [len(pcs)]
+        files = {}
+        for start, end, (function_name, location) in zip(entries, ends, frames):
+            filename = location.rsplit(":", 2)[0]
+            if not filename.startswith(root):
+                # Not part of the project, e.g. the runtime or system headers
+                continue
+            functions, indices = files.setdefault(filename[len(root) :], ([], []))
+            functions.append((function_name, int(end - start)))
+            indices.append(np.arange(start, end))
+        return [
+            (filename, functions, np.concatenate(indices))
+            for filename, (functions, indices) in files.items()
+        ]
+
+    def run(self, testcase):
+        """Coverage of a testcase, or None if it crashed or timed out"""
+        if self.proc is None:
+            self.start()
+
+        self.proc.stdin.write(f"{Path(testcase).absolute()}\n")
+        self.proc.stdin.flush()
+        ready, _, _ = select.select([self.proc.stdout], [], [], self.timeout)
+        status = self.proc.stdout.readline().strip() if ready else None
+        if status == "error":
+            # The input could not be read, the process is still usable
+            rich.print(f"[red]Cannot read test case {testcase}")
+            return None
+        if status != "done":
+            if status is None:
+                rich.print(f"[red]Test case {testcase.name} timed out")
+            self.close()
             return None
 
-        return cov
+        bits = self.counters != 0
+        return {
+            filename: (functions, bits[indices])
+            for filename, functions, indices in self.index
+        }
 
-    before_cov, after_cov = pathos.multiprocessing.ProcessPool(2).map(
-        run_single, [before_conf, after_conf]
-    )
 
+# Runners of the shared-memory mode, indexed by pid and binary. Runners
+# inherited through fork belong to the parent process and are not reused.
+_shm_runners = {}
+
+
+def shm_cov(conf, testcase, timeout):
+    """Coverage of a testcase in the shared-memory mode, see `run_cov`"""
+    key = (os.getpid(), conf.shm_bin)
+    runner = _shm_runners.get(key)
+    if runner is None:
+        runner = ShmCoverageRunner(conf, timeout)
+        _shm_runners[key] = runner
+    return runner.run(testcase)
+
+
+def _function_bits(cov):
+    """Basic block flags of each (filename, function) of a coverage"""
+    res = {}
+    for filename, (functions, bits) in cov.items():
+        offset = 0
+        for function_name, bb_count in functions:
+            res[(filename, function_name)] = bits[offset : offset + bb_count]
+            offset += bb_count
+    return res
+
+
+def diff_cov(before_cov, after_cov):
+    """Functions of the after binary whose coverage differs from before
+
+    A function differs if it does not exist before, if its number of basic
+    blocks changed, or if a basic block is covered in only one of the runs.
+    """
+    before = _function_bits(before_cov)
     res = []
-    if before_cov is None or after_cov is None:
+    for key, bits in _function_bits(after_cov).items():
+        if key not in before or not np.array_equal(before[key], bits):
+            res.append(key)
+    return res
+
+
+class CoverageLayout:
+    """Joint basic block layout of the before and after binaries
+
+    Functions with the same number of basic blocks in both binaries are
+    compared block by block. Their blocks are placed in one bit vector, each
+    function starting on a byte boundary, so that the coverage of a run
+    packs into a uint8 array and the functions covered differently come
+    from a XOR and a reduction over byte segments. The other functions of
+    the after binary differ in every run.
+
+    The layout is built from one pair of runs. A run whose files or
+    functions do not match it is compared with `diff_cov` instead.
+    """
+
+    def __init__(self, before_cov, after_cov):
+        before_counts = {
+            (filename, function_name): bb_count
+            for filename, (functions, _) in before_cov.items()
+            for function_name, bb_count in functions
+        }
+
+        # Comparable functions and their number of basic blocks
+        self.functions = []
+        self.bb_counts = {}
+        # Functions of the after binary differing in every run
+        self.changed = []
+
+        after_offsets = {}
+        byte_starts = []
+        pos = 0
+        for filename in sorted(after_cov):
+            offset = 0
+            for function_name, bb_count in after_cov[filename][0]:
+                key = (filename, function_name)
+                if before_counts.get(key) == bb_count:
+                    self.functions.append(key)
+                    self.bb_counts[key] = bb_count
+                    after_offsets[key] = offset
+                    byte_starts.append(pos // 8)
+                    pos += (bb_count + 7) // 8 * 8
+                else:
+                    self.changed.append(key)
+                offset += bb_count
+        self.size = pos
+        self.byte_starts = np.array(byte_starts, dtype=np.intp)
+        self.nonempty = np.diff(self.byte_starts, append=pos // 8) > 0
+
+        before_offsets = {
+            key: offset
+            for key, offset in self._offsets(before_cov).items()
+            if key in after_offsets
+        }
+
+        self.before = self._structure(before_cov)
+        self.after = self._structure(after_cov)
+        self.before_index = self._gather_index(before_offsets)
+        self.after_index = self._gather_index(after_offsets)
+
+    @staticmethod
+    def _offsets(cov):
+        res = {}
+        for filename, (functions, _) in cov.items():
+            offset = 0
+            for function_name, bb_count in functions:
+                res[(filename, function_name)] = offset
+                offset += bb_count
         return res
 
-    for filename in after_cov:
-        if filename not in before_cov:
-            for function_name in after_cov[filename]:
-                res.append((filename, function_name))
-            # rich.print(f"[red]File {filename} not found in before coverage")
-            continue
-
-        for function_name in after_cov[filename]:
-            if (function_name not in before_cov[filename]) or (
-                len(after_cov[filename][function_name])
-                != len(before_cov[filename][function_name])
-            ):
-                res.append((filename, function_name))
-                # rich.print(f"[red]Function {function_name} has different number of basic blocks")
-
-            elif (
-                after_cov[filename][function_name]
-                != before_cov[filename][function_name]
-            ):
-                res.append((filename, function_name))
-                # rich.print(f"[red]Function {function_name} has different basic block coverage")
+    @staticmethod
+    def _structure(cov):
+        return {filename: functions for filename, (functions, _) in cov.items()}
+
+    def _gather_index(self, offsets):
+        """Positions of each file's basic blocks in the bit vector"""
+        src = {}
+        dst = {}
+        for i, key in enumerate(self.functions):
+            filename = key[0]
+            bb_count = self.bb_counts[key]
+            start = offsets[key]
+            src.setdefault(filename, []).append(np.arange(start, start + bb_count))
+            base = self.byte_starts[i] * 8
+            dst.setdefault(filename, []).append(np.arange(base, base + bb_count))
+        return {
+            filename: (np.concatenate(src[filename]), np.concatenate(dst[filename]))
+            for filename in src
+        }
+
+    def pack(self, cov, structure, index):
+        """Bit vector of a run, or None if it does not match the layout"""
+        if self._structure(cov) != structure:
+            return None
+        bits = np.zeros(self.size, dtype=bool)
+        for filename, (src, dst) in index.items():
+            bits[dst] = cov[filename][1][src]
+        return np.packbits(bits)
+
+    def diff(self, before_cov, after_cov):
+        """Comparable functions covered differently, as a bool array
+
+        Returns None if a run does not match the layout.
+        """
+        before = self.pack(before_cov, self.before, self.before_index)
+        after = self.pack(after_cov, self.after, self.after_index)
+        if before is None or after is None:
+            return None
+        res = np.zeros(len(self.functions), dtype=bool)
+        # Functions without basic blocks have no byte, and the start of a
+        # trailing one would be out of bounds for reduceat
+        starts = self.byte_starts[self.nonempty]
+        if len(starts) > 0:
+            changed = np.bitwise_xor(before, after) != 0
+            res[self.nonempty] = np.logical_or.reduceat(changed, starts)
+        return res
 
-    return res
+
+def run_and_compare(before_conf, after_conf, testcase, timeout):
+    before_cov = run_cov(before_conf, testcase, timeout)
+    after_cov = run_cov(after_conf, testcase, timeout)
+    if before_cov is None or after_cov is None:
+        return []
+    return diff_cov(before_cov, after_cov)
 
 
-def run_and_compare_all(before_conf, after_conf, limit=None, timeout=None):
+def run_and_compare_all(
+    before_conf, after_conf, limit=None, timeout=None, parallel=True, shm=False
+):
 
     corpus = list(corpus_dir(before_conf.name).iterdir())
 
@@ -176,9 +589,68 @@ def run_and_compare_all(before_conf, after_conf, limit=None, timeout=None):
     corpus = random.sample(corpus, corpus_limit)
     counter = Counter()
 
-    for testcase in tqdm(corpus):
-        res = run_and_compare(before_conf, after_conf, testcase, timeout)
-        counter.update(res)
+    # Persistent processes of the shared-memory mode, or one run per input
+    get_cov = shm_cov if shm else run_cov
+
+    # Build the layout from the first testcase both binaries run successfully
+    layout = None
+    while layout is None and len(corpus) > 0:
+        testcase = corpus.pop()
+        before_cov = get_cov(before_conf, testcase, timeout)
+        after_cov = get_cov(after_conf, testcase, timeout)
+        if before_cov is not None and after_cov is not None:
+            layout = CoverageLayout(before_cov, after_cov)
+            counter.update(diff_cov(before_cov, after_cov))
+
+    if layout is None:
+        rich.print(f"[red]No coverage collected for {before_conf.name}")
+        return
+
+    # Number of runs compared with the layout, and how many of them found
+    # each comparable function covered differently
+    compared = 0
+    counts = np.zeros(len(layout.functions), dtype=np.int64)
+
+    def compare(testcase):
+        before_cov = get_cov(before_conf, testcase, timeout)
+        after_cov = get_cov(after_conf, testcase, timeout)
+        if before_cov is None or after_cov is None:
+            return []
+        changed = layout.diff(before_cov, after_cov)
+        if changed is None:
+            return diff_cov(before_cov, after_cov)
+        return np.packbits(changed)
+
+    # One pool for the whole corpus, each task runs the before and after
+    # binaries of one testcase. Without isolated runs, each binary runs one
+    # testcase at a time, and more workers would only wait for its lock.
+    if parallel:
+        isolated = shm or overlay_supported()
+        pool = pathos.multiprocessing.Pool(None if isolated else 2)
+        results = pool.imap_unordered(compare, corpus)
+    else:
+        pool = None
+        results = map(compare, corpus)
+
+    for res in tqdm(results, total=len(corpus)):
+        if isinstance(res, np.ndarray):
+            compared += 1
+            counts += np.unpackbits(res, count=len(layout.functions))
+        else:
+            counter.update(res)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    for runner in _shm_runners.values():
+        runner.close()
+    _shm_runners.clear()
+
+    for i in np.flatnonzero(counts):
+        counter[layout.functions[i]] += int(counts[i])
+    for key in layout.changed:
+        counter[key] += compared
 
     filename, func = zip(*counter.keys())
     count = counter.values()
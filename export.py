@@ -0,0 +1,122 @@
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import rich
+
+from storage import BatchWriter, iter_rows
+
+# Exported tables and their columns, except `project` which is the partition
+# key. Function names and context hashes repeat a lot across rows, so they
+# are dictionary encoded.
+TABLES = {
+    "function": [
+        ("function_name", pa.dictionary(pa.int32(), pa.string())),
+        ("declaration", pa.string()),
+    ],
+    "system_carving": [
+        ("function_name", pa.dictionary(pa.int32(), pa.string())),
+        ("context", pa.binary()),
+        ("context_hash", pa.int64()),
+    ],
+    "unit_carving": [
+        ("function_name", pa.dictionary(pa.int32(), pa.string())),
+        ("testcase", pa.string()),
+        ("context", pa.binary()),
+        ("context_hash", pa.int64()),
+        ("is_crash", pa.bool_()),
+        ("sanitizer_report", pa.string()),
+        ("expr_index", pa.int32()),
+    ],
+    "system_fuzz": [
+        ("testcase", pa.string()),
+        ("sanitizer_report", pa.string()),
+        ("expr_index", pa.int32()),
+    ],
+}
+
+DICTIONARY_COLUMNS = ["function_name", "context_hash", "testcase", "expr_index"]
+
+
+def partition_file(out_dir, table, project):
+    return Path(out_dir) / table / f"project={project}" / "part-0.parquet"
+
+
+def _record_batch(schema, rows):
+    columns = list(zip(*rows))
+    arrays = []
+    for field, values in zip(schema, columns):
+        # psycopg2 returns memoryview for bytea, SQLite returns int for bool
+        if pa.types.is_binary(field.type):
+            values = [None if x is None else bytes(x) for x in values]
+        elif pa.types.is_boolean(field.type):
+            values = [None if x is None else bool(x) for x in values]
+        if pa.types.is_dictionary(field.type):
+            array = pa.array(values, type=field.type.value_type).dictionary_encode()
+        else:
+            array = pa.array(values, type=field.type)
+        arrays.append(array)
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export_project(project, out_dir, batch_size=10000):
+    """Export the results of a project to Parquet
+
+    Each table is written to `<out_dir>/<table>/project=<project>/`, a Hive
+    partitioned layout that `pyarrow.dataset` or DuckDB can scan across
+    projects. Rows are streamed from the database batch by batch.
+
+    Args:
+        project (string): Project name
+        out_dir (Path): Output directory
+        batch_size (int): Number of rows of each row group
+    """
+    for table, columns in TABLES.items():
+        schema = pa.schema(columns)
+        out_file = partition_file(out_dir, table, project)
+        out_file.parent.mkdir(parents=True, exist_ok=True)
+
+        query = "SELECT {} FROM {} WHERE project = %s".format(
+            ", ".join(schema.names), table
+        )
+        count = 0
+        with pq.ParquetWriter(
+            out_file,
+            schema,
+            compression="zstd",
+            use_dictionary=[c for c in schema.names if c in DICTIONARY_COLUMNS],
+        ) as writer:
+            for rows in iter_rows(query, (project,), size=batch_size):
+                writer.write_batch(_record_batch(schema, rows))
+                count += len(rows)
+
+        rich.print(f"[green]Exported {count} rows of {table} to {out_file}")
+
+
+def import_project(project, in_dir, batch_size=10000):
+    """Import the results of a project exported by `export_project`
+
+    Rows already present in the database are skipped.
+
+    Args:
+        project (string): Project name
+        in_dir (Path): Directory given to `export_project`
+        batch_size (int): Number of rows inserted per transaction
+    """
+    for table, columns in TABLES.items():
+        in_file = partition_file(in_dir, table, project)
+        if not in_file.exists():
+            rich.print(f"[red]{in_file} does not exist, skipping {table}")
+            continue
+
+        names = [name for name, _ in columns]
+        count = 0
+        with BatchWriter(table, ["project"] + names, batch_size) as writer:
+            for batch in pq.ParquetFile(in_file).iter_batches(
+                batch_size=batch_size, columns=names
+            ):
+                values = [batch.column(name).to_pylist() for name in names]
+                writer.extend((project,) + row for row in zip(*values))
+                count += batch.num_rows
+
+        rich.print(f"[green]Imported {count} rows of {table} from {in_file}")
@@ -2,13 +2,15 @@ import argparse
 import shutil
 import subprocess
 
-import pathos.multiprocessing as mp
 from tqdm import tqdm
 
+import storage
+from admission import AdmissionPool
 from carve_system import SystemCarving
 from config import *
-from project_base import Project
-from unit_fuzz import get_top_k
+from export import export_project, import_project
+from project_base import BUILDS, VERSIONS, Project, build_all
+from unit_fuzz import feasibility_report, get_top_k
 from unit_prioritization import UnitPrioritization
 from utils import *
 
@@ -82,6 +84,23 @@ def get_parser():
     unit_fuzz_parser.add_argument(
         "--timeout_crash", type=int, default=0, help="timeout of crash analysis"
     )
+    unit_fuzz_parser.add_argument(
+        "--bloom",
+        action="store_true",
+        default=False,
+        help="keep stored contexts in a bloom filter for deduplication",
+    )
+
+    feasibility_parser = subparsers.add_parser(
+        "feasibility", help="unit crash contexts seen at system level"
+    )
+    feasibility_parser.add_argument("artifact")
+    feasibility_parser.add_argument(
+        "--no_refresh",
+        action="store_true",
+        default=False,
+        help="report without refreshing feasible_unit_crash",
+    )
 
     # Used to compare the performance with unit fuzzing
     system_fuzz_parser = subparsers.add_parser("system_fuzz", help="system fuzz")
@@ -151,6 +170,18 @@ def get_parser():
     system_carving_parser.add_argument(
         "--raw", action="store_true", default=False, help="raw carving"
     )
+    system_carving_parser.add_argument(
+        "--select",
+        action="store_true",
+        default=False,
+        help="carve testcases reaching target functions (requires unit_prioritization)",
+    )
+    system_carving_parser.add_argument(
+        "--bloom",
+        action="store_true",
+        default=False,
+        help="keep stored contexts in a bloom filter for deduplication",
+    )
 
     build_parser = subparsers.add_parser("build")
     build_parser.add_argument("artifact")
@@ -168,6 +199,26 @@ def get_parser():
         "--clear", action="store_true", help="clean old src and out directory"
     )
 
+    build_all_parser = subparsers.add_parser(
+        "build_all", help="build all variants of an artifact concurrently"
+    )
+    build_all_parser.add_argument("artifact")
+    build_all_parser.add_argument(
+        "--version", nargs="+", default=list(VERSIONS), choices=VERSIONS
+    )
+    build_all_parser.add_argument(
+        "--tag", nargs="+", default=list(BUILDS), choices=list(BUILDS)
+    )
+    build_all_parser.add_argument(
+        "-j", type=int, help="total number of CPUs to use (default: all)"
+    )
+    build_all_parser.add_argument(
+        "--clear", action="store_true", help="clean old src and out directory"
+    )
+    build_all_parser.add_argument(
+        "--debug", action="store_true", default=False, help="show build output"
+    )
+
     corpus_correctness_parser = subparsers.add_parser(
         "corpus_correctness", help="corpus correctness"
     )
@@ -179,6 +230,32 @@ def get_parser():
     coverage_parser.add_argument(
         "--clear", action="store_true", help="clean old src and out directory"
     )
+    coverage_parser.add_argument(
+        "--chunk_size", type=int, default=64, help="number of inputs per process"
+    )
+    coverage_parser.add_argument(
+        "--per_input",
+        action="store_true",
+        default=False,
+        help="also save the coverage of each input",
+    )
+    coverage_parser.add_argument("--timeout", type=int, help="timeout of each process")
+
+    export_parser = subparsers.add_parser(
+        "export", help="export carving and triage results to parquet"
+    )
+    export_parser.add_argument("artifact")
+    export_parser.add_argument(
+        "--dir", default="data/export", help="output directory"
+    )
+
+    import_parser = subparsers.add_parser(
+        "import", help="import carving and triage results from parquet"
+    )
+    import_parser.add_argument("artifact")
+    import_parser.add_argument(
+        "--dir", default="data/export", help="directory given to export"
+    )
 
     return parser
 
@@ -206,7 +283,26 @@ if __name__ == "__main__":
         else:
             assert False, "Unknown compiler"
 
-    if args.command == "replay":
+    elif args.command == "build_all":
+        if args.clear:
+            for version in args.version:
+                for tag in args.tag:
+                    p = Project(args.artifact, version, tag=tag)
+                    shutil.rmtree(p.src_dir, ignore_errors=True)
+                    shutil.rmtree(p.out_dir, ignore_errors=True)
+                    shutil.rmtree(p.work_dir, ignore_errors=True)
+
+        failed = build_all(
+            args.artifact,
+            versions=args.version,
+            tags=args.tag,
+            cpus=args.j,
+            debug=args.debug,
+        )
+        if len(failed) > 0:
+            exit(1)
+
+    elif args.command == "replay":
         # Requires gllvm base with sanitizer
         version = "bic-after"
         p = Project(args.artifact, version, tag="replay")
@@ -314,7 +410,7 @@ if __name__ == "__main__":
                 for u, i in tqdm(jobs):
                     u.run_fuzzer(i, timeout=args.timeout)
             else:
-                with mp.Pool(mp.cpu_count()) as pool:
+                with AdmissionPool("unit_fuzz", args.artifact) as pool:
                     for _ in pool.imap_unordered(
                         lambda x: x[0].run_fuzzer(x[1], timeout=args.timeout), jobs
                     ):
@@ -323,7 +419,9 @@ if __name__ == "__main__":
         if not args.skip_carving:
             for u, i in jobs:
                 kill_ipcs()
-                u.run_carving(i, multi=(not args.no_parallel), timeout=10)
+                u.run_carving(
+                    i, multi=(not args.no_parallel), timeout=10, bloom=args.bloom
+                )
 
         crashes = [
             (i, u, testcase)
@@ -343,41 +441,35 @@ if __name__ == "__main__":
         def postprocess_crash(i, u, testcase):
             stacktrace = get_stacktrace(u.trace_bin, testcase, debug=args.debug)
             if stacktrace is None:
-                return None
+                return None, None
 
             out = parse_stacktrace(stacktrace, u.src_dir)
             if args.debug:
                 print(out)
 
-            conn = create_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE unit_carving SET sanitizer_report=%s WHERE project=%s AND function_name=%s AND testcase=%s AND expr_index=%s",
-                (stacktrace, args.artifact, u.function, testcase.name, i),
-            )
-
-            conn.commit()
-            cursor.close()
-            conn.close()
-
-            return "\n".join(out)
+            # Stored by the main process in batches
+            update = (stacktrace, args.artifact, u.function, testcase.name, i)
+            return "\n".join(out), update
 
         collect = [set() for _ in repeat]
-        if args.no_parallel:
-            for i, u, testcase in tqdm(crashes):
-                trace = postprocess_crash(i, u, testcase)
-                if trace is not None:
-                    collect[i].add(trace)
-        else:
-            with mp.Pool(mp.cpu_count()) as pool:
-                for i, trace in tqdm(
-                    pool.imap_unordered(
-                        lambda x: (x[0], postprocess_crash(*x)), crashes
-                    ),
-                    total=len(crashes),
-                ):
+        with storage.sanitizer_report_updater() as updater:
+            if args.no_parallel:
+                for i, u, testcase in tqdm(crashes):
+                    trace, update = postprocess_crash(i, u, testcase)
                     if trace is not None:
                         collect[i].add(trace)
+                        updater.add(update)
+            else:
+                with AdmissionPool("triage", args.artifact) as pool:
+                    for i, (trace, update) in tqdm(
+                        pool.imap_unordered(
+                            lambda x: (x[0], postprocess_crash(*x)), crashes
+                        ),
+                        total=len(crashes),
+                    ):
+                        if trace is not None:
+                            collect[i].add(trace)
+                            updater.add(update)
 
         for i in repeat:
             print(f"Iter {i}: {len(collect[i])} unique crashes")
@@ -407,6 +499,10 @@ if __name__ == "__main__":
 
         print(out_text)
 
+    elif args.command == "feasibility":
+        df = feasibility_report(args.artifact, refresh=(not args.no_refresh))
+        print(df.to_string(index=False))
+
     elif args.command == "system_fuzz":
         fp = Project(args.artifact, "bic-after", tag="aflpp")
         rp = Project(args.artifact, "bic-after", tag="replay")
@@ -439,7 +535,7 @@ if __name__ == "__main__":
 
         if not args.skip_fuzz:
             shutil.rmtree(fp.data_dir / "system_fuzz", ignore_errors=True)
-            with mp.Pool(mp.cpu_count()) as pool:
+            with AdmissionPool("system_fuzz", args.artifact) as pool:
                 # fp.run_fuzz(i, timeout=args.timeout), range(args.n)
                 for _ in pool.imap_unordered(
                     lambda i: fp.run_fuzz(i, timeout=args.timeout, debug=args.debug),
@@ -481,7 +577,7 @@ if __name__ == "__main__":
                 if trace is not None:
                     collect[i // cluster_size].add(trace)
         else:
-            with mp.Pool(mp.cpu_count()) as pool:
+            with AdmissionPool("triage", args.artifact) as pool:
                 for i, trace in tqdm(
                     pool.imap_unordered(
                         lambda x: (x[0], postprocess_crash(*x)), crashes
@@ -560,6 +656,8 @@ if __name__ == "__main__":
                 parallel=(not args.no_parallel),
                 debug=args.debug,
                 raw=args.raw,
+                bloom=args.bloom,
+                select=args.select,
             )
 
         p.count_system_testcases(funcs)
@@ -580,8 +678,29 @@ if __name__ == "__main__":
         if not corpus_dir.is_absolute():
             corpus_dir = Path.cwd() / corpus_dir
 
-        for testcase in tqdm(list(corpus_dir.glob("id:*"))):
-            check_call([p.bin, testcase], cwd=p.src_dir, print=True)
+        corpus = [str(testcase) for testcase in corpus_dir.glob("id:*")]
+        summary = p.run_coverage(
+            corpus,
+            chunk_size=args.chunk_size,
+            per_input=args.per_input,
+            timeout=args.timeout,
+        )
+
+        def ratio(kind):
+            covered = summary[f"{kind}_covered"]
+            total = summary[f"{kind}_total"]
+            percent = 100 * covered / total if total > 0 else 0
+            return f"{kind}: {covered} / {total} ({percent:.2f}%)"
+
+        print(f"{len(corpus)} inputs")
+        for kind in ["lines", "functions", "branches"]:
+            print(ratio(kind))
+
+    elif args.command == "export":
+        export_project(args.artifact, Path(args.dir))
+
+    elif args.command == "import":
+        import_project(args.artifact, Path(args.dir))
 
     else:
         # help message
@@ -1,17 +1,30 @@
+import hashlib
 import json
+import os
 import shutil
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from queue import Queue
 
+import pandas as pd
 import pathos.multiprocessing as mp
 import rich
 from tqdm import tqdm
 
-from config import AFL_FUZZ, LIBFUZZER_DRIVER
-from utils import check_call, run
+from config import (AFL_FUZZ, COMPILER_CACHE, COMPILER_CACHE_DIR, GCOV,
+                    LIBFUZZER_DRIVER, SNAPSHOT_DIR, SNAPSHOT_LINKS)
+from utils import TailBuffer, async_check_call, check_call, run, run_async_jobs
 
 VERSIONS = ("bic-before", "bic-after")
 
+# Build tags whose debug info is never symbolized by the pipeline. Only their
+# objects refer to the source tree as ".", which makes them reusable across
+# versions; the other tags keep the absolute paths that `get_function_list`,
+# sanitizer traces and coverage symbolization rely on.
+RELOCATABLE_TAGS = ("aflpp", "aflchurn")
+
 
 class Project:
     def __init__(self, name, version, tag):
@@ -34,6 +47,8 @@ class Project:
         self.project = name.split("-")[0]
         self.version = version
         self.tag = tag
+        # CPUs the build is restricted to, see `build_all`
+        self.cpus = None
         self.hash = json_row[version]
         self.sanitizer = json_row["sanitizer"]
         self.fuzzer = json_row["fuzzer"]
@@ -66,6 +81,42 @@ class Project:
         )
 
     def get_source(self):
+        """Copy the source of the artifact into `src_dir`
+
+        The source is extracted from the artifact image once into a snapshot
+        shared by all build tags. Where the file system supports reflinks,
+        each tag gets a copy-on-write copy that it can modify freely.
+        Otherwise the tags share the snapshot files through hard links (see
+        `SNAPSHOT_LINKS`): the snapshot is made read-only, so that a build
+        writing into a shared file in place fails instead of changing the
+        source of every tag, while files replaced by a new one (`sed -i`,
+        `patch`, generated files) stay private to the tag.
+        """
+        snapshot = self.get_snapshot()
+        self.src_dir.mkdir(parents=True, exist_ok=True)
+        if reflink_supported(SNAPSHOT_DIR, self.src_dir):
+            cmd = ["cp", "-a", "--reflink=always"]
+        elif SNAPSHOT_LINKS:
+            check_call(
+                ["find", snapshot, "-type", "f", "-perm", "/222"]
+                + ["-exec", "chmod", "a-w", "{}", "+"]
+            )
+            cmd = ["cp", "-al", "--remove-destination"]
+        else:
+            cmd = ["cp", "-a"]
+        check_call(cmd + [f"{snapshot}/.", self.src_dir])
+
+    def get_snapshot(self):
+        """Source snapshot of the artifact, extracted if missing
+
+        Snapshots are keyed by the content of the artifact directory, i.e.
+        the Dockerfile and its build context.
+        """
+        key = f"{self.name}-{self.version}-{artifact_hash(self.artifact)}"
+        snapshot = SNAPSHOT_DIR / key
+        if snapshot.exists():
+            return snapshot
+
         image_name = f"regression-unit-framework/{self.name}:{self.version}"
         docker_build_cmd = [
             "docker",
@@ -80,12 +131,34 @@ class Project:
         container_id = (
             subprocess.check_output(["docker", "create", image_name]).decode().strip()
         )
-        self.src_dir.mkdir(parents=True, exist_ok=True)
-
-        check_call(["docker", "cp", f"{container_id}:/src/.", self.src_dir])
-        check_call(["docker", "rm", container_id])
 
-    def _build(self, new_env, debug=False):
+        # Stream /src as a tar archive straight into the snapshot directory
+        SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(tempfile.mkdtemp(dir=SNAPSHOT_DIR))
+        tmp_dir.chmod(0o755)
+        try:
+            rich.print(f"[green]docker cp {container_id}:/src/. - | tar -x -C {tmp_dir}")
+            docker_cp = subprocess.Popen(
+                ["docker", "cp", f"{container_id}:/src/.", "-"], stdout=subprocess.PIPE
+            )
+            subprocess.check_call(["tar", "-x", "-C", tmp_dir], stdin=docker_cp.stdout)
+            docker_cp.stdout.close()
+            if docker_cp.wait() != 0:
+                raise subprocess.CalledProcessError(docker_cp.returncode, "docker cp")
+            try:
+                os.rename(tmp_dir, snapshot)
+            except OSError:
+                # Extracted concurrently by another build tag
+                shutil.rmtree(tmp_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        finally:
+            check_call(["docker", "rm", container_id])
+
+        return snapshot
+
+    def _build(self, new_env, debug=False, cache=True):
         default_env = {
             "OUT": str(self.out_dir),
             "SRC": str(self.src_dir),
@@ -101,9 +174,76 @@ class Project:
         self.work_dir.mkdir(parents=True, exist_ok=True)
 
         build_cmd = ["bash", "../build.sh"]
+        if self.cpus is not None:
+            # nproc in build.sh also reports the size of the CPU set
+            new_env["MAKEFLAGS"] = f"-j{len(self.cpus)}"
+            build_cmd = ["taskset", "-c", ",".join(map(str, self.cpus))] + build_cmd
+
+        stats_log = None
+        if COMPILER_CACHE and cache:
+            if shutil.which("ccache") is not None:
+                stats_log = self._setup_compiler_cache(new_env)
+            else:
+                rich.print("[red]ccache not found, building without compiler cache")
 
         run(build_cmd, cwd=self.src_project_dir, env=new_env, quiet=(not debug))
 
+        if stats_log is not None:
+            hits, misses, uncacheable = parse_ccache_log(stats_log)
+            total = hits + misses
+            rate = 100 * hits / total if total > 0 else 0
+            if self.tag in RELOCATABLE_TAGS:
+                scope = "all versions"
+            else:
+                scope = f"{self.version} only, debug info keeps absolute paths"
+            rich.print(
+                f"[green]ccache {self.name} {self.version} {self.tag}: {hits} hits, {misses} misses ({rate:.1f}%), {uncacheable} uncacheable, objects shared by {scope}"
+            )
+
+    def _setup_compiler_cache(self, new_env):
+        """Route CC and CXX of a build through ccache
+
+        Compilers are wrapped in scripts rather than prefixed, since build
+        systems do not all accept a command with arguments in CC. Paths are
+        rewritten relative to `src_dir`, so that objects compiled for one
+        version are reused by the other when their preprocessed source and
+        flags are the same. For builds with debug info, this only holds for
+        `RELOCATABLE_TAGS`, where the debug info refers to `src_dir` as ".";
+        the other tags reuse objects across rebuilds of the same version.
+
+        Returns:
+            Path: ccache statistics log of this build
+        """
+        wrapper_dir = self.work_dir / "ccache"
+        wrapper_dir.mkdir(parents=True, exist_ok=True)
+        for var, default in [("CC", "cc"), ("CXX", "c++")]:
+            wrapper = wrapper_dir / default
+            wrapper.write_text(
+                f'#!/bin/sh\nexec ccache {new_env.get(var, default)} "$@"\n'
+            )
+            wrapper.chmod(0o755)
+            new_env[var] = str(wrapper)
+
+        if self.tag in RELOCATABLE_TAGS:
+            prefix_map = f" -fdebug-prefix-map={self.src_dir}=."
+            for var in ["CFLAGS", "CXXFLAGS"]:
+                new_env[var] = new_env.get(var, "") + prefix_map
+
+        stats_log = self.work_dir / "ccache.log"
+        stats_log.unlink(missing_ok=True)
+        new_env.update(
+            {
+                "CCACHE_DIR": str(COMPILER_CACHE_DIR),
+                "CCACHE_BASEDIR": str(self.src_dir),
+                "CCACHE_SLOPPINESS": "include_file_mtime,include_file_ctime,time_macros",
+                "CCACHE_STATSLOG": str(stats_log),
+                # gclang keeps a copy of the bitcode of cached objects here
+                "WLLVM_BC_STORE": str(COMPILER_CACHE_DIR / "bitcode"),
+            }
+        )
+        (COMPILER_CACHE_DIR / "bitcode").mkdir(parents=True, exist_ok=True)
+        return stats_log
+
     def build_aflpp(self, debug=False):
         new_env = {
             "LIB_FUZZING_ENGINE": str(
@@ -161,9 +301,10 @@ class Project:
             "SAVE_TEMPS": "-save-temps" if save_temps else "",
         }
 
-        self._build(new_env, debug=debug)
+        # ccache cannot cache -save-temps, whose .i files units are made from
+        self._build(new_env, debug=debug, cache=not save_temps)
 
-    def build_gllvm(self):
+    def build_gllvm(self, debug=False):
         new_env = {
             "LIB_FUZZING_ENGINE": str(LIBFUZZER_DRIVER),
             "CC": "gclang",
@@ -172,9 +313,9 @@ class Project:
             "CXXFLAGS": "-O0 -g -DFUZZING_BUILD_MODE_UNSAFE_FOR_PRODUCTION",
         }
 
-        self._build(new_env)
+        self._build(new_env, debug=debug)
 
-    def build_coverage(self):
+    def build_coverage(self, debug=False):
         new_env = {
             "LIB_FUZZING_ENGINE": str(LIBFUZZER_DRIVER),
             "CC": "clang",
@@ -184,7 +325,7 @@ class Project:
             "COVERAGE_FLAGS": "--coverage -fPIC",
         }
 
-        self._build(new_env)
+        self._build(new_env, debug=debug)
 
     def get_function_list(self):
         get_bc_cmd = ["get-bc", "-o", f"{self.bin}.bc", self.bin]
@@ -199,10 +340,6 @@ class Project:
             "/dev/null",
         ]
 
-        check_call(get_bc_cmd)
-        out = check_call(opt_cmd)
-        out = out.stdout.decode().splitlines()
-
         def process_line(line):
             space = line.find(" ")
             filename = line[:space]
@@ -221,10 +358,17 @@ class Project:
                 "end": end,
             }
 
-        out = map(process_line, out)
-        out = list(
-            filter(lambda x: x["filename"].startswith(str(self.src_project_dir)), out)
-        )
+        # The listing covers every linked library, keep only the rows of the
+        # project while it is printed instead of buffering all of it
+        out = []
+
+        def on_line(line):
+            row = process_line(line.decode().rstrip("\n"))
+            if row["filename"].startswith(str(self.src_project_dir)):
+                out.append(row)
+
+        check_call(get_bc_cmd)
+        check_call(opt_cmd, stdout=on_line, stderr=TailBuffer())
         return out
 
     def build_replay(self, debug=False):
@@ -262,18 +406,105 @@ class Project:
 
     def check_corpus_correctness(self):
         corpus = list(self.corpus.iterdir())
-        pool = mp.Pool(mp.cpu_count())
 
-        def check_one(testcase):
+        async def check_one(testcase):
             try:
-                subprocess.check_call([self.bin, testcase], timeout=10)
+                await async_check_call([self.bin, testcase], timeout=10, quiet=True)
             except subprocess.CalledProcessError:
                 rich.print(f"[red]Error: {testcase}")
             except subprocess.TimeoutExpired:
                 rich.print(f"[red]Timeout: {testcase}")
 
-        for _ in tqdm(pool.imap_unordered(check_one, corpus), total=len(corpus)):
-            pass
+        run_async_jobs(check_one, corpus)
+
+    def run_coverage(self, corpus, chunk_size=64, per_input=False, timeout=None):
+        """Run the corpus with the `build_coverage` binary and summarize
+
+        The counters of previous runs are removed first. The corpus is split
+        in chunks, each run by one process of the standalone driver, so that
+        the counters of a chunk are merged in memory and written once. The
+        runtime merges the counters of concurrent processes into the same
+        .gcda files. A chunk whose process fails loses its counters, so its
+        inputs are run again one by one.
+
+        With `per_input`, every input also runs alone with its counters
+        redirected by GCOV_PREFIX, to get the coverage of each input.
+
+        Args:
+            corpus (list): Testcases
+            chunk_size (int): Number of testcases per process
+            per_input (bool): Also compute the coverage of each input
+            timeout (int): Timeout of each process in seconds
+
+        Returns:
+            dict: Line, function and branch coverage, see `gcov_summary`
+        """
+        for gcda in self.src_dir.rglob("*.gcda"):
+            gcda.unlink()
+
+        def run_chunk(chunk):
+            try:
+                out = subprocess.run(
+                    [self.bin] + chunk,
+                    cwd=self.src_dir,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=timeout,
+                )
+                if out.returncode == 0:
+                    return
+            except subprocess.TimeoutExpired:
+                pass
+            if len(chunk) > 1:
+                for testcase in chunk:
+                    run_chunk([testcase])
+
+        chunks = [corpus[i : i + chunk_size] for i in range(0, len(corpus), chunk_size)]
+        with mp.Pool(mp.cpu_count()) as pool:
+            for _ in tqdm(pool.imap_unordered(run_chunk, chunks), total=len(chunks)):
+                pass
+
+        summary = gcov_summary(list(self.src_dir.rglob("*.gcda")))
+
+        if per_input:
+
+            def run_single(testcase):
+                with tempfile.TemporaryDirectory() as prefix:
+                    try:
+                        subprocess.run(
+                            [self.bin, testcase],
+                            cwd=self.src_dir,
+                            env=dict(os.environ, GCOV_PREFIX=prefix),
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL,
+                            timeout=timeout,
+                        )
+                    except subprocess.TimeoutExpired:
+                        return testcase, None
+                    # Counters are written under the prefix, next to a link to
+                    # the notes file of the build
+                    gcda_files = []
+                    for gcda in Path(prefix).rglob("*.gcda"):
+                        gcno = Path("/") / gcda.relative_to(prefix).with_suffix(".gcno")
+                        if not gcno.is_relative_to(self.src_dir):
+                            continue
+                        gcda.with_suffix(".gcno").symlink_to(gcno)
+                        gcda_files.append(gcda)
+                    return testcase, gcov_summary(gcda_files)
+
+            rows = []
+            with mp.Pool(mp.cpu_count()) as pool:
+                for testcase, res in tqdm(
+                    pool.imap_unordered(run_single, corpus), total=len(corpus)
+                ):
+                    if res is not None:
+                        rows.append({"testcase": Path(testcase).name, **res})
+            out_file = self.data_dir / "coverage_per_input.csv"
+            out_file.parent.mkdir(parents=True, exist_ok=True)
+            pd.DataFrame(rows).to_csv(out_file, index=False)
+            rich.print(f"[green]Per-input coverage saved to {out_file}")
+
+        return summary
 
     def run_fuzz(self, i, timeout, debug):
         fuzz_out_dir = self.fuzz_out_dir(i)
@@ -303,3 +534,183 @@ class Project:
         run(cmd, new_env, quiet=True)
 
         return fuzz_out_dir / "default" / "crashes"
+
+
+# Build method of each build tag
+BUILDS = {
+    "gllvm": "build_gllvm",
+    "gnu": "build_gnu",
+    "aflpp": "build_aflpp",
+    "replay": "build_replay",
+    "coverage": "build_coverage",
+}
+
+
+def build_all(name, versions=VERSIONS, tags=tuple(BUILDS), cpus=None, debug=False):
+    """Build several variants of an artifact concurrently
+
+    The whole CPU budget is split into disjoint CPU sets, one per concurrent
+    build. Each build runs under `taskset` with `make -j` set to the size of
+    its set, so the builds together never use more than the budget. The
+    source of each version is extracted once before the builds start.
+
+    Args:
+        name (string): Artifact name
+        versions (list): Versions to build
+        tags (list): Build tags to build, keys of `BUILDS`
+        cpus (int): CPU budget, all available CPUs by default
+        debug (bool): Show build output
+
+    Returns:
+        list: (version, tag, exception) of the failed builds
+    """
+    available = sorted(os.sched_getaffinity(0))
+    if cpus is not None:
+        available = available[: max(cpus, 1)]
+
+    projects = [Project(name, version, tag) for version in versions for tag in tags]
+    slots = min(len(projects), len(available))
+    # The CPUs left over by an even split go one each to the first sets
+    size, extra = divmod(len(available), slots)
+    cpu_sets = Queue()
+    start = 0
+    for i in range(slots):
+        end = start + size + (1 if i < extra else 0)
+        cpu_sets.put(available[start:end])
+        start = end
+
+    for version in versions:
+        Project(name, version, tags[0]).get_snapshot()
+
+    def build(p):
+        cpu_set = cpu_sets.get()
+        try:
+            p.cpus = cpu_set
+            p.get_source()
+            getattr(p, BUILDS[p.tag])(debug=debug)
+            rich.print(f"[green]Built {p.name} {p.version} {p.tag}")
+            return None
+        except Exception as e:
+            rich.print(f"[red]Failed to build {p.name} {p.version} {p.tag}: {e}")
+            return (p.version, p.tag, e)
+        finally:
+            cpu_sets.put(cpu_set)
+
+    with ThreadPoolExecutor(slots) as executor:
+        results = list(executor.map(build, projects))
+
+    return [x for x in results if x is not None]
+
+
+def parse_ccache_log(stats_log):
+    """Count the results of a ccache statistics log
+
+    Returns:
+        tuple: Number of cache hits, misses, and compilations that ccache
+        could not cache, e.g. linking or unsupported options
+    """
+    hits = misses = uncacheable = 0
+    if not stats_log.exists():
+        return hits, misses, uncacheable
+    for line in stats_log.read_text().splitlines():
+        if line == "" or line.startswith("#"):
+            continue
+        if line in ("direct_cache_hit", "preprocessed_cache_hit"):
+            hits += 1
+        elif line == "cache_miss":
+            misses += 1
+        else:
+            uncacheable += 1
+    return hits, misses, uncacheable
+
+
+# Reflink support of (source, destination) devices, checked on first use
+_reflink_support = {}
+
+
+def reflink_supported(src, dst):
+    """Whether files of directory `src` can be reflinked into `dst`"""
+    key = (os.stat(src).st_dev, os.stat(dst).st_dev)
+    if key not in _reflink_support:
+        with tempfile.NamedTemporaryFile(dir=src) as probe:
+            target = Path(dst) / f".reflink-{os.getpid()}"
+            out = subprocess.run(
+                ["cp", "--reflink=always", probe.name, target],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            target.unlink(missing_ok=True)
+        _reflink_support[key] = out.returncode == 0
+        if not _reflink_support[key]:
+            if SNAPSHOT_LINKS:
+                mode = "hard links to the read-only snapshot"
+            else:
+                mode = "full copies of the snapshot"
+            rich.print(f"[red]No reflink support in {dst}, build tags use {mode}")
+    return _reflink_support[key]
+
+
+def artifact_hash(artifact):
+    """Hash of the files of an artifact directory"""
+    h = hashlib.blake2b(digest_size=8)
+    for path in sorted(artifact.rglob("*")):
+        if path.is_file():
+            h.update(str(path.relative_to(artifact)).encode("utf-8") + b"\0")
+            h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+def gcov_summary(gcda_files):
+    """Summarize gcov counters
+
+    Runs `llvm-cov gcov` in summary mode over the given .gcda files. A
+    source file or function that appears in several objects, e.g. a header,
+    is counted once with its best coverage.
+
+    Returns:
+        dict: Covered and total lines, functions and branches
+    """
+    files = {}
+    functions = {}
+    if len(gcda_files) > 0:
+        with tempfile.TemporaryDirectory() as tmp:
+            out = subprocess.run(
+                GCOV + ["-n", "-b", "-f"] + [str(x) for x in gcda_files],
+                cwd=tmp,
+                capture_output=True,
+                text=True,
+            ).stdout
+
+        name = None
+        for line in out.splitlines():
+            if line.startswith("File '") or line.startswith("Function '"):
+                name = line
+                if line.startswith("Function '"):
+                    functions.setdefault(name, 0)
+                else:
+                    files.setdefault(name, [0, 0, 0, 0])
+            elif name is None:
+                continue
+            elif line.startswith("Lines executed:"):
+                percent, total = line[len("Lines executed:") :].split("% of ")
+                covered = round(float(percent) * int(total) / 100)
+                if name in functions:
+                    functions[name] = max(functions[name], covered)
+                else:
+                    files[name][0] = max(files[name][0], covered)
+                    files[name][1] = int(total)
+            elif line.startswith("Taken at least once:") and name in files:
+                percent, total = line[len("Taken at least once:") :].split("% of ")
+                files[name][2] = max(
+                    files[name][2], round(float(percent) * int(total) / 100)
+                )
+                files[name][3] = int(total)
+
+    return {
+        "lines_covered": sum(x[0] for x in files.values()),
+        "lines_total": sum(x[1] for x in files.values()),
+        "functions_covered": sum(1 for x in functions.values() if x > 0),
+        "functions_total": len(functions),
+        "branches_covered": sum(x[2] for x in files.values()),
+        "branches_total": sum(x[3] for x in files.values()),
+    }
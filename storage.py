@@ -0,0 +1,477 @@
+import hashlib
+import math
+import os
+import sqlite3
+from pathlib import Path
+
+from psycopg2.extras import execute_values
+
+from config import SQLITE_DB, STORAGE_BACKEND, create_connection
+
+
+def context_hash(content):
+    """Hash of a carved context, stored in the `context_hash` column
+
+    Computed on the client so that every backend stores the same value.
+    The digest is folded into a signed 64-bit integer to fit `bigint`.
+
+    Args:
+        content (bytes or string): `dump_context` output, or raw context text
+    """
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    digest = hashlib.blake2b(content, digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+class PostgresBackend:
+    name = "postgres"
+
+    def connect(self):
+        return create_connection()
+
+    def translate(self, query):
+        return query
+
+    def legacy_context_tables(self, cursor, tables):
+        cursor.execute(
+            "SELECT table_name FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name IN %s "
+            "AND column_name = 'context' "
+            "AND data_type <> 'bytea'",
+            (tuple(tables),),
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def stream_cursor(self, conn):
+        # Server-side cursor, rows are transferred as they are fetched. It is
+        # held across commits, since writers share the connection.
+        return conn.cursor(name="stream", withhold=True)
+
+    def insert_many(self, cursor, table, columns, rows, page_size):
+        query = "INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING".format(
+            table, ", ".join(columns)
+        )
+        execute_values(cursor, query, rows, page_size=page_size)
+
+    def refresh_feasible_unit_crash(self, cursor):
+        cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY feasible_unit_crash")
+
+    def update_many(self, cursor, table, columns, keys, rows, page_size):
+        query = "UPDATE {0} SET {1} FROM (VALUES %s) AS data ({2}) WHERE {3}".format(
+            table,
+            ", ".join(f"{c} = data.{c}" for c in columns),
+            ", ".join(columns + keys),
+            " AND ".join(f"{table}.{k} = data.{k}" for k in keys),
+        )
+        execute_values(cursor, query, rows, page_size=page_size)
+
+
+class SQLiteBackend:
+    """Embedded backend for single-node campaigns
+
+    The database file is opened in WAL mode so that readers do not block the
+    writer, and the schema in `assets/init_sqlite.sql` is created on connect.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def connect(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        schema = Path(__file__).parent / "assets" / "init_sqlite.sql"
+        conn.executescript(schema.read_text())
+        return conn
+
+    def translate(self, query):
+        # Queries are written in psycopg2 paramstyle
+        return query.replace("%s", "?")
+
+    def legacy_context_tables(self, cursor, tables):
+        legacy = []
+        for table in tables:
+            cursor.execute(f"PRAGMA table_info({table})")
+            if any(row[1] == "context" and row[2] != "BLOB" for row in cursor):
+                legacy.append(table)
+        return legacy
+
+    def stream_cursor(self, conn):
+        return conn.cursor()
+
+    def insert_many(self, cursor, table, columns, rows, page_size):
+        query = "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT DO NOTHING".format(
+            table, ", ".join(columns), ", ".join(["?"] * len(columns))
+        )
+        cursor.executemany(query, rows)
+
+    def refresh_feasible_unit_crash(self, cursor):
+        cursor.execute("DELETE FROM feasible_unit_crash")
+        cursor.execute(
+            """
+            INSERT INTO feasible_unit_crash
+            SELECT u.project, u.function_name, u.context_hash, u.expr_index, u.testcase
+            FROM unit_carving u
+            JOIN system_carving s
+                ON s.project = u.project
+                AND s.function_name = u.function_name
+                AND s.context_hash = u.context_hash
+            WHERE u.is_crash
+            """
+        )
+
+    def update_many(self, cursor, table, columns, keys, rows, page_size):
+        query = "UPDATE {} SET {} WHERE {}".format(
+            table,
+            ", ".join(f"{c} = ?" for c in columns),
+            " AND ".join(f"{k} = ?" for k in keys),
+        )
+        cursor.executemany(query, rows)
+
+
+def get_backend():
+    if STORAGE_BACKEND == "postgres":
+        return PostgresBackend()
+    elif STORAGE_BACKEND == "sqlite":
+        return SQLiteBackend(SQLITE_DB)
+    else:
+        raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
+
+
+backend = get_backend()
+
+# Connections indexed by the pid of the process that opened them. Entries
+# inherited through fork are kept alive on purpose: dropping them would close
+# the socket that is still shared with the parent process.
+_connections = {}
+
+
+# Tables holding contexts packed by `carve_common.pack_context`
+CONTEXT_TABLES = ["system_carving", "unit_carving"]
+
+
+def check_schema(conn):
+    """Refuse to use carving tables created before contexts were packed
+
+    Their context column holds rendered text hashed by `hashtextextended`,
+    which can neither be loaded nor deduplicated against packed contexts.
+    """
+    cursor = conn.cursor()
+    try:
+        legacy = backend.legacy_context_tables(cursor, CONTEXT_TABLES)
+    finally:
+        cursor.close()
+    conn.rollback()
+    if legacy:
+        raise RuntimeError(
+            f"{', '.join(legacy)}: contexts are stored as text by an older "
+            "schema. Drop these tables, or use a new database, and carve again."
+        )
+
+
+def get_connection():
+    """Return the database connection of the current process
+
+    The connection is opened on first use and reused afterwards, so a process
+    connects once instead of once per carved file. The schema is checked
+    when the connection is opened.
+    """
+    pid = os.getpid()
+    conn = _connections.get(pid)
+    if conn is None:
+        conn = backend.connect()
+        check_schema(conn)
+        _connections[pid] = conn
+    return conn
+
+
+def fetch_all(query, params=()):
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(backend.translate(query), params)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    # Do not leave a transaction open on the shared connection
+    conn.rollback()
+    return rows
+
+
+def iter_rows(query, params=(), size=10000):
+    """Run a query and yield its rows in lists of at most `size` rows
+
+    Unlike `fetch_all`, the result is never held in memory as a whole.
+    """
+    conn = get_connection()
+    cursor = backend.stream_cursor(conn)
+    try:
+        cursor.execute(backend.translate(query), params)
+        while True:
+            rows = cursor.fetchmany(size)
+            if len(rows) == 0:
+                break
+            yield rows
+    finally:
+        cursor.close()
+        conn.rollback()
+
+
+def execute(query, params=()):
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(backend.translate(query), params)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def refresh_feasible_unit_crash():
+    """Recompute `feasible_unit_crash` from the carving tables"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        backend.refresh_feasible_unit_crash(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+class BloomFilter:
+    """Bloom filter over hashable keys
+
+    Args:
+        capacity (int): Expected number of keys
+        error_rate (float): Target false positive rate at `capacity`
+    """
+
+    def __init__(self, capacity, error_rate=1e-6):
+        capacity = max(capacity, 1)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.num_hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing over two halves of a 128-bit digest
+        digest = hashlib.blake2b(repr(key).encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.num_hashes))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class ContextDedup:
+    """Set of carved contexts that are already stored
+
+    Keys seeded from the database go to a Bloom filter when `capacity` is
+    set, which keeps memory small for large tables at the cost of dropping a
+    new context with probability `error_rate`. Keys added afterwards are
+    kept in an exact set.
+
+    Args:
+        capacity (int): Number of seeded keys, or None to keep them exactly
+        error_rate (float): False positive rate of the Bloom filter
+    """
+
+    def __init__(self, capacity=None, error_rate=1e-6):
+        self.seen = set()
+        self.bloom = None
+        if capacity is not None:
+            self.bloom = BloomFilter(capacity, error_rate)
+
+    def seed(self, keys):
+        """Record keys that are already stored"""
+        if self.bloom is None:
+            self.seen.update(keys)
+            return
+        for key in keys:
+            self.bloom.add(key)
+
+    def add(self, key):
+        """Record `key`, returning True if it was not seen before"""
+        if key in self.seen or (self.bloom is not None and key in self.bloom):
+            return False
+        self.seen.add(key)
+        return True
+
+
+# Dedup state of the current carving run indexed by (table, project). It is
+# consulted by the process that inserts the rows, which sees the rows of
+# every worker.
+_dedups = {}
+
+
+def load_dedup(table, project, key_columns, function_name=None, bloom=False):
+    """Seed the dedup state of `table` with the keys stored for `project`
+
+    The keys are streamed from the database, so with `bloom` only the Bloom
+    filter is held in memory.
+
+    Args:
+        table (string): Table name
+        project (string): Project name
+        key_columns (list): Columns identifying a context, e.g.
+            ["function_name", "context_hash"]
+        function_name (string): Only load the keys of this function
+        bloom (bool): Keep the stored keys in a Bloom filter
+    """
+    where = "WHERE project = %s"
+    params = (project,)
+    if function_name is not None:
+        where += " AND function_name = %s"
+        params += (function_name,)
+
+    capacity = None
+    if bloom:
+        capacity = fetch_all(f"SELECT count(*) FROM {table} {where}", params)[0][0]
+    dedup = ContextDedup(capacity)
+    query = "SELECT {} FROM {} {}".format(", ".join(key_columns), table, where)
+    for rows in iter_rows(query, params):
+        dedup.seed(map(tuple, rows))
+    _dedups[(table, project)] = dedup
+
+
+def is_new_context(table, project, key):
+    """Check `key` against the dedup state of `table` and record it"""
+    dedup = _dedups.get((table, project))
+    if dedup is None:
+        return True
+    return dedup.add(key)
+
+
+class BatchWriter:
+    """Buffer rows for one table and insert them in batches
+
+    Rows are inserted with `INSERT ... ON CONFLICT DO NOTHING` inside a single
+    transaction per batch. The buffer holds at most `batch_size` rows; it is
+    flushed when it is full and when the writer is closed.
+
+    Args:
+        table (string): Table name
+        columns (list): Column names in row order
+        batch_size (int): Maximum number of buffered rows
+    """
+
+    def __init__(self, table, columns, batch_size=1000):
+        self.table = table
+        self.columns = columns
+        self.batch_size = batch_size
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def extend(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            self.write(cursor)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        self.rows = []
+
+    def write(self, cursor):
+        backend.insert_many(
+            cursor, self.table, self.columns, self.rows, self.batch_size
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+
+class BatchUpdater(BatchWriter):
+    """Buffer updates of existing rows and apply them in batches
+
+    Rows hold the new values of `columns` followed by the values of `keys`
+    identifying the rows to update. On Postgres a batch is a single
+    `UPDATE ... FROM (VALUES ...)` statement.
+
+    Args:
+        table (string): Table name
+        columns (list): Updated columns
+        keys (list): Key columns
+        batch_size (int): Maximum number of buffered rows
+    """
+
+    def __init__(self, table, columns, keys, batch_size=1000):
+        super().__init__(table, columns, batch_size)
+        self.keys = keys
+
+    def write(self, cursor):
+        backend.update_many(
+            cursor, self.table, self.columns, self.keys, self.rows, self.batch_size
+        )
+
+
+def carving_writer(table):
+    """BatchWriter for `system_carving`-like tables
+
+    Rows are (project, function_name, context, context_hash), where context
+    is packed (see `carve_common.pack_context`) except for raw carving.
+    """
+    return BatchWriter(table, ["project", "function_name", "context", "context_hash"])
+
+
+def unit_carving_writer():
+    """BatchWriter for `unit_carving`
+
+    Rows are (project, function_name, testcase, context, context_hash,
+    is_crash, expr_index), where context is packed.
+    """
+    return BatchWriter(
+        "unit_carving",
+        [
+            "project",
+            "function_name",
+            "testcase",
+            "context",
+            "context_hash",
+            "is_crash",
+            "expr_index",
+        ],
+    )
+
+
+def sanitizer_report_updater():
+    """BatchUpdater of `unit_carving.sanitizer_report`
+
+    Rows are (sanitizer_report, project, function_name, testcase, expr_index).
+    """
+    return BatchUpdater(
+        "unit_carving",
+        ["sanitizer_report"],
+        ["project", "function_name", "testcase", "expr_index"],
+    )
@@ -6,16 +6,20 @@ import tempfile
 from pathlib import Path
 
 import pandas as pd
-import pathos
 import rich
 from tqdm import tqdm
 
-from carve_common import parse_carve_filename, process_context
-from config import (AFL_FUZZ, AFLCC, CARVING_LLVM, CROWN_HARNESS_GENERATOR,
-                    CROWN_TC_GENERATOR, PIN, create_connection)
+from admission import AdmissionPool
+from carve_common import (CarvingCache, dump_context, encode_carve_file,
+                          pack_context, parse_carve_filename)
+from config import (AFL_FUZZ, AFL_SHOWMAP, AFLCC, CARVE_CACHE, CARVING_LLVM,
+                    CROWN_HARNESS_GENERATOR, CROWN_TC_GENERATOR, PIN)
 from project_base import Project
+from storage import (context_hash, execute, fetch_all, is_new_context,
+                     load_dedup, refresh_feasible_unit_crash,
+                     unit_carving_writer)
 from utils import *
-from utils import check_call
+from utils import check_call, select_max_coverage
 
 
 class Unit(Project):
@@ -66,15 +70,10 @@ class Unit(Project):
 
     def save_declaration(self):
         assert self.declaration is not None
-        conn = create_connection()
-        cursor = conn.cursor()
-        cursor.execute(
+        execute(
             "INSERT INTO function (project, function_name, declaration) Values (%s, %s, %s) ON CONFLICT DO NOTHING",
             (self.name, self.function, self.declaration),
         )
-        conn.commit()
-        cursor.close()
-        conn.close()
 
     def generate_harness(self, null=True, length=2, ignore_exist=True, debug=False):
         if ignore_exist:
@@ -289,16 +288,110 @@ class Unit(Project):
 
         assert Path(self.carver_bin).exists()
 
-    def run_carving(self, i, pass_limit=100, timeout=None, multi=True, testcase=None):
+    def queue_edges(self, queue_dir, timeout=None):
+        """Edge coverage of each queue entry measured with afl-showmap
+
+        Args:
+            queue_dir (Path): AFL queue directory
+            timeout (int): Timeout of each execution in seconds
+
+        Returns:
+            dict: Set of edge ids of each entry, or None if afl-showmap failed.
+            Entries without a map, e.g. ones that crashed or timed out, are
+            left out.
+        """
+        with tempfile.TemporaryDirectory() as map_dir:
+            cmd = [AFL_SHOWMAP, "-q", "-e", "-i", queue_dir, "-o", map_dir]
+            if timeout is not None:
+                cmd += ["-t", str(timeout * 1000)]
+            cmd += ["--", self.fuzzer_bin, "@@"]
+            try:
+                check_call(cmd, quiet=True, print=False)
+            except (OSError, subprocess.CalledProcessError) as e:
+                rich.print(f"[red]afl-showmap failed on {queue_dir}: {e}")
+                return None
+
+            edges = {}
+            failed = []
+            for testcase in queue_dir.glob("id:*"):
+                map_file = Path(map_dir) / testcase.name
+                # Every execution covers some edge, an empty map is a failure
+                if not map_file.exists() or map_file.stat().st_size == 0:
+                    failed.append(testcase)
+                    continue
+                edges[testcase] = {
+                    line.split(":")[0]
+                    for line in map_file.read_text().split("\n")
+                    if line != ""
+                }
+        if len(failed) > 0:
+            rich.print(
+                f"[red]afl-showmap produced no map for {len(failed)} entries of {queue_dir}, skipped"
+            )
+        if len(edges) == 0:
+            return None
+        return edges
+
+    def select_queue(self, queue_dir, limit, timeout=None):
+        """Select a subset of the AFL queue with diverse edge coverage
+
+        Entries are picked greedily by the number of new edges they cover.
+        If afl-showmap cannot be run, entries that AFL marked with new
+        coverage (`+cov` in the file name) are preferred instead.
+
+        Args:
+            queue_dir (Path): AFL queue directory
+            limit (int): Maximum number of entries to select
+            timeout (int): Timeout of each afl-showmap execution in seconds
+
+        Returns:
+            list: Selected queue entries
+        """
+        queue = sorted(queue_dir.glob("id:*"))
+        if len(queue) <= limit:
+            return queue
+
+        edges = self.queue_edges(queue_dir, timeout=timeout)
+        if edges is None:
+            rich.print(f"[red]afl-showmap failed on {queue_dir}, using queue metadata")
+            queue.sort(key=lambda x: "+cov" not in x.name)
+            return queue[:limit]
+
+        selected = select_max_coverage(edges, limit)
+        selected_set = set(selected)
+        rest = [x for x in queue if x not in selected_set]
+        return selected + rest[: limit - len(selected)]
+
+    def run_carving(
+        self,
+        i,
+        pass_limit=100,
+        timeout=None,
+        multi=True,
+        testcase=None,
+        bloom=False,
+        select=True,
+        use_cache=True,
+    ):
         fuzz_out_dir = self.fuzz_out_base / f"fuzz_out_{i}"
         pass_testcase_dir = fuzz_out_dir / "default" / "queue"
         fail_testcase_dir = fuzz_out_dir / "default" / "crashes"
 
-        def carve_and_postprocess(arg):
-            is_crash, testcase = arg
-            conn = create_connection()
-            cursor = conn.cursor()
+        cache = CarvingCache(CARVE_CACHE, self.carver_bin) if use_cache else None
+
+        def carve(testcase):
+            """Carve the context of the function from `testcase`
 
+            Only the output file of the function is read and parsed.
+
+            Returns:
+                tuple: (data, reached) where data is the `dump_context`
+                output, or None if the function was not reached or its
+                context is malformed, and reached is the set of functions
+                carved from `testcase`
+            """
+            data = None
+            reached = set()
             with tempfile.TemporaryDirectory() as out_dir:
                 cmd_carv = [
                     PIN,
@@ -309,64 +402,148 @@ class Unit(Project):
                     testcase,
                     out_dir,
                 ]
-                try:
-                    with tempfile.TemporaryDirectory() as run_dir:
-                        run(
-                            cmd_carv,
-                            timeout=timeout,
-                            cwd=run_dir,
-                            quiet=True,
-                            print=False,
-                        )
-                    for carve_file in Path(out_dir).glob(f"*"):
-                        carve_name = carve_file.name
-                        carved_function, call_idx = parse_carve_filename(carve_name)
-                        if carved_function != self.function or call_idx != 1:
-                            continue
-                        content = carve_file.read_text()
-                        content = process_context(content)
-
-                        cursor.execute(
-                            "INSERT INTO unit_carving (project, function_name, testcase, context, context_hash, is_crash, sanitizer_report, expr_index) Values (%s, %s, %s, %s, hashtextextended(%s, 0), %s, NULL, %s) ON CONFLICT DO NOTHING",
-                            (
-                                self.name,
-                                self.function,
-                                testcase.name,
-                                content,
-                                content,
-                                is_crash,
-                                i,
-                            ),
+                with tempfile.TemporaryDirectory() as run_dir:
+                    run(
+                        cmd_carv,
+                        timeout=timeout,
+                        cwd=run_dir,
+                        quiet=True,
+                        print=False,
+                    )
+                for carve_file in Path(out_dir).glob(f"*"):
+                    carve_name = carve_file.name
+                    carved_function, call_idx = parse_carve_filename(carve_name)
+                    if call_idx != 1:
+                        continue
+                    reached.add(carved_function)
+                    if carved_function != self.function:
+                        continue
+                    context = encode_carve_file(carve_file)
+                    if context is None:
+                        rich.print(
+                            f"[red]Exception while carving {testcase}\n{carve_file}[/red]"
                         )
-                        break
+                        continue
+                    data = dump_context(context)
+            return data, reached
 
-                except subprocess.TimeoutExpired:
-                    rich.print(f"[red]Timeout while carving {testcase}")
-                except Exception:
-                    rich.print(f"[red]Exception while carving {testcase}")
+        def carve_and_postprocess(arg):
+            is_crash, testcase = arg
 
-            conn.commit()
-            cursor.close()
-            conn.close()
-            return
+            rows = []
+
+            try:
+                hit = False
+                if cache is not None:
+                    key = cache.key(testcase)
+                    hit, data = cache.get(key, self.function)
+                if not hit:
+                    data, reached = carve(testcase)
+                    if cache is not None:
+                        cache.put(key, reached, self.function, data)
+
+                if data is None:
+                    return rows
+
+                rows.append(
+                    (
+                        self.name,
+                        self.function,
+                        testcase.name,
+                        pack_context(data),
+                        context_hash(data),
+                        is_crash,
+                        i,
+                    )
+                )
+
+            except subprocess.TimeoutExpired:
+                rich.print(f"[red]Timeout while carving {testcase}")
+            except Exception:
+                rich.print(f"[red]Exception while carving {testcase}")
+            return rows
 
         # testcase in pass directory and fail directory
         if testcase is None:
-            args = [(False, x) for x in pass_testcase_dir.glob("*")][:pass_limit] + [
+            if select:
+                passes = self.select_queue(pass_testcase_dir, pass_limit, timeout)
+            else:
+                passes = list(pass_testcase_dir.glob("*"))[:pass_limit]
+            args = [(False, x) for x in passes] + [
                 (True, x) for x in fail_testcase_dir.glob("*")
             ]
         else:
             args = testcase
 
-        if multi:
-            pool = pathos.multiprocessing.Pool()
-            for _ in tqdm(
-                pool.imap_unordered(carve_and_postprocess, args), total=len(args)
-            ):
-                pass
-        else:
-            for arg in tqdm(args):
-                carve_and_postprocess(arg)
+        load_dedup(
+            "unit_carving",
+            self.name,
+            ["function_name", "context_hash", "expr_index"],
+            function_name=self.function,
+            bloom=bloom,
+        )
+
+        def new_rows(rows):
+            # Drop contexts already stored or carved from another testcase
+            return [
+                row
+                for row in rows
+                if is_new_context("unit_carving", self.name, (row[1], row[4], row[6]))
+            ]
+
+        # Rows are sent back to this process, deduplicated across workers and
+        # inserted in batches
+        with unit_carving_writer() as writer:
+            if multi:
+                with AdmissionPool("unit_carving", self.name) as pool:
+                    for rows in tqdm(
+                        pool.imap_unordered(carve_and_postprocess, args),
+                        total=len(args),
+                    ):
+                        writer.extend(new_rows(rows))
+            else:
+                for arg in tqdm(args):
+                    writer.extend(new_rows(carve_and_postprocess(arg)))
+
+
+def feasibility_report(name, refresh=True):
+    """Crash contexts of each unit that were also carved at system level
+
+    A unit-level crash whose context was observed during system carving is
+    reachable from the system entry point, and so a feasible regression.
+
+    Args:
+        name (string): Project name
+        refresh (bool): Refresh `feasible_unit_crash` first
+
+    Returns:
+        DataFrame: Number of distinct crash contexts and feasible crash
+        contexts of each function
+    """
+    if refresh:
+        refresh_feasible_unit_crash()
+
+    crashes = fetch_all(
+        "SELECT function_name, COUNT(DISTINCT context_hash) FROM unit_carving WHERE project = %s AND is_crash GROUP BY function_name",
+        (name,),
+    )
+    feasible = dict(
+        fetch_all(
+            "SELECT function_name, COUNT(DISTINCT context_hash) FROM feasible_unit_crash WHERE project = %s GROUP BY function_name",
+            (name,),
+        )
+    )
+    return pd.DataFrame(
+        [
+            {
+                "Function": function_name,
+                "Crash contexts": count,
+                "Feasible": feasible.get(function_name, 0),
+            }
+            for function_name, count in crashes
+        ],
+        columns=["Function", "Crash contexts", "Feasible"],
+    )
 
 
 def get_top_k(name, version, tag="gnu", k=10, decl_save=False):
@@ -5,14 +5,58 @@ from collections import Counter
 from queue import Queue
 
 import pandas as pd
-import pathos.multiprocessing as mp
 import pydot
 import rich
 from tqdm.rich import tqdm
 
+from admission import AdmissionPool
 from config import PRINT_FUNCTION, corpus_dir
 from project_base import Project
-from utils import check_call, get_cmd
+from utils import TailBuffer, check_call, get_cmd
+
+
+def parse_symbol_file(symbol_file):
+    """Parse the functions recorded by a funcseq run
+
+    Args:
+        symbol_file (Path): `.symbol` output of the funcseq binary
+
+    Returns:
+        set: (src_filename, function) tuples, or None if the format is invalid
+    """
+    symbols = set()
+    lines = map(lambda s: s.rstrip(), symbol_file.read_text().split("\n"))
+
+    # Grammar: {{ index }} {{ function }} at {{ src_filename }}
+    for line in lines:
+        if line == "":
+            continue
+        i = line.rfind(" ")
+        src_filename = line[i + 1 :]
+        line = line[:i]
+
+        # Check 'at' keyword
+        if "at" != line[-2:]:
+            return None
+        line = line[:-3]
+
+        # Parse index
+        i = line.find(" ")
+        try:
+            _index = int(line[:i])
+            line = line[i + 1 :]
+        except ValueError:
+            return None
+
+        # Parse function
+        function = line
+
+        assert function.strip() == function
+        assert src_filename.strip() == src_filename
+
+        symbols.add((src_filename, function))
+
+    return symbols
 
 
 class UnitPrioritization(Project):
@@ -77,8 +121,15 @@ class UnitPrioritization(Project):
 
             try:
                 if not (skip_exist and seq_file.exists() and symbol_file.exists()):
+                    # The sequence goes to OUT_FILE, only keep a bounded
+                    # excerpt of what the harness prints
                     check_call(
-                        [self.funcseq, testcase], env=env, timeout=timeout, print=False
+                        [self.funcseq, testcase],
+                        env=env,
+                        timeout=timeout,
+                        print=False,
+                        stdout=TailBuffer(1 << 16),
+                        stderr=TailBuffer(1 << 16),
                     )
                 assert seq_file.exists()
                 assert symbol_file.exists()
@@ -99,42 +150,11 @@ class UnitPrioritization(Project):
                 # symbol_file.unlink()
                 # return set()
 
-            # Parse the symbol file
-            symbols = set()
-            lines = map(lambda s: s.rstrip(), symbol_file.read_text().split("\n"))
-
-            # Grammar: {{ index }} {{ function }} at {{ src_filename }}
-            for line in lines:
-                if line == "":
-                    continue
-                i = line.rfind(" ")
-                src_filename = line[i + 1 :]
-                line = line[:i]
-
-                # Check 'at' keyword
-                if "at" != line[-2:]:
-                    rich.print(f"[red]Invalid file format in {symbol_file}")
-                    symbol_file.unlink()
-                    return set()
-                line = line[:-3]
-
-                # Parse index
-                i = line.find(" ")
-                try:
-                    _index = int(line[:i])
-                    line = line[i + 1 :]
-                except ValueError:
-                    rich.print(f"[red]Invalid file format in {symbol_file}")
-                    symbol_file.unlink()
-                    return set()
-
-                # Parse function
-                function = line
-
-                assert function.strip() == function
-                assert src_filename.strip() == src_filename
-
-                symbols.add((src_filename, function))
+            symbols = parse_symbol_file(symbol_file)
+            if symbols is None:
+                rich.print(f"[red]Invalid file format in {symbol_file}")
+                symbol_file.unlink()
+                return set()
 
             return symbols
 
@@ -145,7 +165,7 @@ class UnitPrioritization(Project):
 
         # Run all
         if not debug:
-            with mp.Pool(mp.cpu_count()) as pool:
+            with AdmissionPool("callseq", self.name) as pool:
                 symbols_it = list(
                     tqdm(pool.imap_unordered(run, corpus), total=len(corpus))
                 )
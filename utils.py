@@ -1,11 +1,15 @@
+import asyncio
+import heapq
 import os
 import re
 import subprocess
-from io import StringIO
+import threading
+from io import BytesIO, StringIO
 from pathlib import Path
 
 import pandas as pd
 import rich
+from tqdm import tqdm
 from tree_sitter import Language, Parser
 
 
@@ -38,7 +42,136 @@ def run(cmd, env={}, cwd=None, print=True, quiet=False, timeout=None):
         subprocess.run(cmd, env=_env, cwd=cwd, timeout=timeout)
 
 
-def check_call(cmd, env={}, cwd=None, print=True, timeout=None, quiet=False):
+class TailBuffer:
+    """Keep the first and last `size` bytes of an output stream
+
+    Memory stays bounded by about `3 * size` bytes however long the output
+    is. Bytes in between are dropped and replaced by a marker.
+    """
+
+    def __init__(self, size=1 << 20):
+        if size < 0:
+            raise ValueError(f"Negative TailBuffer size: {size}")
+        self.size = size
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.skipped = 0
+
+    def write(self, data):
+        if len(self.head) < self.size:
+            n = self.size - len(self.head)
+            self.head += data[:n]
+            data = data[n:]
+        self.tail += data
+        # Trim in amortized steps instead of on every write. The slice is not
+        # written as [:-size], which would keep everything when size is 0.
+        if len(self.tail) > 2 * self.size:
+            self.skipped += len(self.tail) - self.size
+            del self.tail[: len(self.tail) - self.size]
+
+    def getvalue(self):
+        skipped = self.skipped + max(len(self.tail) - self.size, 0)
+        tail = self.tail[-self.size :] if self.size > 0 else b""
+        if skipped == 0:
+            return bytes(self.head + tail)
+        marker = f"\n... {skipped} bytes skipped ...\n".encode()
+        return bytes(self.head) + marker + bytes(tail)
+
+
+def _drain(pipe, sink):
+    """Read `pipe` until EOF into a buffer or a line callback
+
+    Once the callback returns True, the remaining output is read and
+    discarded so that the process never blocks on a full pipe.
+    """
+    if callable(sink):
+        stopped = False
+        # Bounded reads, a line without newline is passed in pieces
+        for line in iter(lambda: pipe.readline(1 << 16), b""):
+            if not stopped:
+                stopped = bool(sink(line))
+    else:
+        for chunk in iter(lambda: pipe.read1(1 << 16), b""):
+            sink.write(chunk)
+    pipe.close()
+
+
+def _run_captured(cmd, env, cwd, timeout, stdout, stderr):
+    sinks = {"stdout": stdout, "stderr": stderr}
+    files = []
+    args = {}
+    for name, sink in sinks.items():
+        if isinstance(sink, (str, Path)):
+            # Written by the process itself, never passing through Python
+            f = open(sink, "wb")
+            files.append(f)
+            args[name] = f
+        else:
+            args[name] = subprocess.PIPE
+
+    try:
+        proc = subprocess.Popen(cmd, env=env, cwd=cwd, stdin=subprocess.DEVNULL, **args)
+    finally:
+        for f in files:
+            f.close()
+
+    buffers = {}
+    threads = []
+    for name, sink in sinks.items():
+        pipe = getattr(proc, name)
+        if pipe is None:
+            continue
+        if sink is None:
+            sink = BytesIO()
+        buffers[name] = sink
+        thread = threading.Thread(target=_drain, args=(pipe, sink), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    outputs = {name: None for name in sinks}
+    for name, sink in buffers.items():
+        if not callable(sink):
+            outputs[name] = sink.getvalue()
+    return subprocess.CompletedProcess(
+        cmd, proc.returncode, outputs["stdout"], outputs["stderr"]
+    )
+
+
+def check_call(
+    cmd,
+    env={},
+    cwd=None,
+    print=True,
+    timeout=None,
+    quiet=False,
+    stdout=None,
+    stderr=None,
+):
+    """Run a command and raise `subprocess.CalledProcessError` on failure
+
+    By default the whole output is kept in memory. `stdout` and `stderr`
+    select another capture mode for large outputs:
+
+    - a path: the stream is written to that file, and the returned output
+      is None
+    - a `TailBuffer`: only the head and tail of the stream are kept
+    - a callable: called with each line as bytes while the process runs,
+      and the returned output is None. Returning True stops the calls, e.g.
+      once a sanitizer summary has been seen.
+
+    Returns:
+        subprocess.CompletedProcess: Return code and output in bytes
+    """
     if print:
         if cwd is None:
             rich.print(f"[green]{get_cmd(cmd, env)}")
@@ -48,12 +181,21 @@ def check_call(cmd, env={}, cwd=None, print=True, timeout=None, quiet=False):
     _env = os.environ.copy()
     _env.update(env)
 
-    stdout_pipe = subprocess.DEVNULL if quiet else subprocess.PIPE
-    stderr_pipe = subprocess.DEVNULL if quiet else subprocess.PIPE
+    if quiet or (stdout is None and stderr is None):
+        stdout_pipe = subprocess.DEVNULL if quiet else subprocess.PIPE
+        stderr_pipe = subprocess.DEVNULL if quiet else subprocess.PIPE
+
+        out = subprocess.run(
+            cmd,
+            env=_env,
+            cwd=cwd,
+            timeout=timeout,
+            stdout=stdout_pipe,
+            stderr=stderr_pipe,
+        )
+    else:
+        out = _run_captured(cmd, _env, cwd, timeout, stdout, stderr)
 
-    out = subprocess.run(
-        cmd, env=_env, cwd=cwd, timeout=timeout, stdout=stdout_pipe, stderr=stderr_pipe
-    )
     if out.returncode != 0:
         if quiet:
             raise subprocess.CalledProcessError(out.returncode, cmd)
@@ -64,6 +206,177 @@ def check_call(cmd, env={}, cwd=None, print=True, timeout=None, quiet=False):
     return out
 
 
+async def _read_lines(stream, lines, callback):
+    """Read `stream` until EOF, passing each line to `callback`
+
+    The stream is read in chunks, so lines of any length are accepted; like
+    `_drain`, a line without newline is passed in pieces of at most 64 KiB.
+    """
+    pending = b""
+    while True:
+        chunk = await stream.read(1 << 16)
+        if len(chunk) == 0:
+            break
+        if lines is not None:
+            lines.append(chunk)
+        if callback is None:
+            continue
+        pending += chunk
+        while True:
+            end = pending.find(b"\n") + 1
+            if end == 0:
+                if len(pending) < 1 << 16:
+                    break
+                end = 1 << 16
+            callback(pending[:end])
+            pending = pending[end:]
+    if callback is not None and len(pending) > 0:
+        callback(pending)
+
+
+async def async_run(
+    cmd,
+    env={},
+    cwd=None,
+    print=False,
+    quiet=False,
+    timeout=None,
+    stdin=None,
+    on_stdout=None,
+    on_stderr=None,
+):
+    """Async counterpart of `run` returning the completed process
+
+    Output is read line by line while the process runs and passed to
+    `on_stdout` and `on_stderr` as it arrives. It is also collected in the
+    returned `CompletedProcess` unless `quiet` is set, in which case it is
+    discarded.
+
+    Args:
+        stdin (bytes): Input written to the process
+        timeout (float): Seconds before the process is killed and
+            `subprocess.TimeoutExpired` is raised
+
+    Returns:
+        subprocess.CompletedProcess: Return code and output in bytes
+    """
+    if print:
+        if cwd is None:
+            rich.print(f"[green]{get_cmd(cmd, env)}")
+        else:
+            rich.print(f"[green]cd {cwd} && \\ \n{get_cmd(cmd, env)}")
+
+    _env = os.environ.copy()
+    _env.update(env)
+
+    capture = not quiet or on_stdout is not None or on_stderr is not None
+    pipe = asyncio.subprocess.PIPE if capture else asyncio.subprocess.DEVNULL
+    proc = await asyncio.create_subprocess_exec(
+        *map(str, cmd),
+        env=_env,
+        cwd=cwd,
+        stdin=(
+            asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL
+        ),
+        stdout=pipe,
+        stderr=pipe,
+    )
+
+    stdout, stderr = [], []
+    tasks = []
+    if capture:
+        tasks.append(_read_lines(proc.stdout, None if quiet else stdout, on_stdout))
+        tasks.append(_read_lines(proc.stderr, None if quiet else stderr, on_stderr))
+    if stdin is not None:
+
+        async def write_stdin():
+            proc.stdin.write(stdin)
+            try:
+                await proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            proc.stdin.close()
+
+        tasks.append(write_stdin())
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*tasks, proc.wait()), timeout)
+    except asyncio.TimeoutError:
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    finally:
+        # Also on errors of a callback or cancellation, never leave the
+        # process running with nobody reading its pipes
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+    if quiet:
+        return subprocess.CompletedProcess(cmd, proc.returncode)
+    return subprocess.CompletedProcess(
+        cmd, proc.returncode, b"".join(stdout), b"".join(stderr)
+    )
+
+
+async def async_check_call(
+    cmd, env={}, cwd=None, print=False, timeout=None, quiet=False, **kwargs
+):
+    """Async counterpart of `check_call`
+
+    Raises:
+        subprocess.CalledProcessError: The process returned non-zero
+    """
+    out = await async_run(
+        cmd, env=env, cwd=cwd, print=print, quiet=quiet, timeout=timeout, **kwargs
+    )
+    if out.returncode != 0:
+        raise subprocess.CalledProcessError(
+            out.returncode, cmd, out.stdout, out.stderr
+        )
+    return out
+
+
+def run_async_jobs(func, items, limit=None, progress=True):
+    """Run `func` on each item in one event loop and return the results
+
+    Meant for many short subprocesses: each job is a coroutine awaiting
+    `async_run` or `async_check_call`, so that a child costs one process
+    instead of a pool worker plus its child. At most `limit` jobs run at a
+    time; a coroutine is only created when a slot is free.
+
+    Args:
+        func (function): Coroutine function taking one item
+        items (iterable): Job inputs
+        limit (int): Maximum number of concurrent jobs, CPU count by default
+        progress (bool): Show a progress bar
+
+    Returns:
+        list: Results in the order of `items`. An exception raised by a job
+        is returned in place of its result.
+    """
+    if limit is None:
+        limit = os.cpu_count()
+    items = list(items)
+
+    async def main():
+        results = [None] * len(items)
+        it = iter(enumerate(items))
+        bar = tqdm(total=len(items), disable=(not progress))
+
+        async def worker():
+            for i, item in it:
+                try:
+                    results[i] = await func(item)
+                except Exception as e:
+                    results[i] = e
+                bar.update(1)
+
+        await asyncio.gather(*(worker() for _ in range(min(limit, len(items)))))
+        bar.close()
+        return results
+
+    return asyncio.run(main())
+
+
 def kill_ipcs():
     cmd = ["bash", "assets/kill_ipcs.sh"]
     subprocess.run(cmd)
@@ -123,6 +436,40 @@ def get_last_modified_date(path_dir):
     return last_modified
 
 
+def select_max_coverage(features, limit=None):
+    """Greedily pick keys covering the most features
+
+    Lazy greedy algorithm for maximum coverage: the gain of a key is only
+    recomputed when it reaches the top of the heap.
+
+    Args:
+        features (dict): Set of features of each key
+        limit (int): Maximum number of keys to pick
+
+    Returns:
+        list: Picked keys in order of selection. Keys adding no new feature
+        are never picked.
+    """
+    if limit is None:
+        limit = len(features)
+
+    heap = [(-len(f), i, key) for i, (key, f) in enumerate(features.items())]
+    heapq.heapify(heap)
+    covered = set()
+    selected = []
+    while heap and len(selected) < limit:
+        _, i, key = heapq.heappop(heap)
+        gain = len(features[key] - covered)
+        if gain == 0:
+            continue
+        if heap and gain < -heap[0][0]:
+            heapq.heappush(heap, (-gain, i, key))
+        else:
+            selected.append(key)
+            covered |= features[key]
+    return selected
+
+
 def get_declaration(src_file, function):
     parser = Parser()
     parser.set_language(Language("tools/c_language.so", "c"))